@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+# Benchmarks for lexconvert.py.  Generates synthetic input for every format
+# in lexconvert's table (from a fixed random seed, so runs are comparable)
+# and times the main stages.
+
+# Usage: python benchmark.py [--quick] [--save results.json] [--baseline results.json] [--threshold 10]
+# Results go to standard output as JSON.  With --baseline, each result is
+# also compared against a saved run (on standard error), and the exit status
+# is 1 if anything got slower by more than --threshold percent.
+
+import sys,os,time,random,tempfile,shutil,subprocess,json,StringIO
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import lexconvert
+
+def best_time(func,repeat):
+    # Runs func() 'repeat' times and returns the fastest (least disturbed) time
+    times = []
+    for r in xrange(repeat):
+        t = time.time() ; func() ; times.append(time.time()-t)
+    return min(times)
+
+def random_pronunc(rand,fmt,length):
+    # A pronunciation of 'length' phonemes picked from the given format's column of the table
+    col = list(lexconvert.table[0]).index(fmt)
+    symbols = [row[col] for row in lexconvert.table[1:] if row[col]]
+    if fmt in lexconvert.formats_where_space_separates_words: sep = ''
+    else: sep = ' '
+    pronunc = sep.join([rand.choice(symbols) for i in xrange(length)])
+    if type(pronunc)==unicode: pronunc = pronunc.encode('utf-8') # as it would come from a file
+    return pronunc
+
+def random_word(rand): return "".join([rand.choice("abcdefghijklmnopqrstuvwxyz") for i in xrange(rand.randint(2,12))])
+
+def bench_import(repeat):
+    # Importing lexconvert (in a new interpreter each time) expands the table
+    cmd = [sys.executable,"-c","import lexconvert"]
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    return {"import":(best_time(lambda:subprocess.check_call(cmd,cwd=cwd),repeat),1)}
+
+def bench_dictionaries(repeat):
+    pairs = [(source,dest) for source in lexconvert.table[0] for dest in lexconvert.table[0]]
+    def build():
+        for source,dest in pairs: lexconvert.build_dictionary(source,dest)
+    return {"build_dictionary (all pairs)":(best_time(build,repeat),len(pairs))}
+
+def bench_convert(rand,repeat,count):
+    results = {}
+    formats = list(lexconvert.table[0])
+    lexconvert.prewarm_converters() # (building the converters is timed separately above)
+    for length in [3,8,20]:
+        for source in formats:
+            pronuncs = [random_pronunc(rand,source,length) for i in xrange(count)]
+            def run():
+                for dest in formats:
+                    for p in pronuncs:
+                        try: lexconvert.convert_uncached(p,source,dest)
+                        except IndexError: pass # (random symbols can put a stress mark where it can't go, e.g. before any vowel)
+            results["convert %s->all, %d phonemes" % (source,length)] = (best_time(run,repeat),count*len(formats))
+    return results
+
+def bench_oed(rand,repeat,count):
+    symbols = lexconvert.oed_alt_symbols.keys()+list("bdfhklmnprstvwz")+["',","(",")","{shtibar}","{shtubar}"]
+    text = ", ".join(["/"+"".join([rand.choice(symbols) for i in xrange(rand.randint(3,10))]).replace("(","").replace(")","")+"/" for i in xrange(count)])
+    return {"OED_alt_to_espeak":(best_time(lambda:lexconvert.OED_alt_to_espeak(text),repeat),count)}
+
+def bench_festival(rand,tmpDir,repeat,count):
+    fname = os.path.join(tmpDir,"oald.scm")
+    f = open(fname,"w")
+    for i in xrange(count):
+        syllables = ["((%s) %d)" % (random_pronunc(rand,"festival",rand.randint(1,4)).replace("0","").replace("1","").replace("2",""),rand.randint(0,2)) for s in xrange(rand.randint(1,4))]
+        f.write('("%s" %s (%s))\n' % (random_word(rand),rand.choice(["n","v","j","nil"]),' '.join(syllables)))
+    f.close()
+    return {"parse_festival_dict":(best_time(lambda:list(lexconvert.parse_festival_dict(fname)),repeat),count)}
+
+def bench_lexicon(rand,tmpDir,repeat,count):
+    # convert_user_lexicon reads en_extra from the current directory
+    f = open(os.path.join(tmpDir,"en_extra"),"w")
+    for i in xrange(count): f.write("%s %s\n" % (random_word(rand),random_pronunc(rand,"espeak",rand.randint(3,10))))
+    f.close()
+    oldDir = os.getcwd() ; os.chdir(tmpDir)
+    try: return {"convert_user_lexicon espeak->cepstral":(best_time(lambda:lexconvert.convert_user_lexicon("espeak","cepstral",StringIO.StringIO()),repeat),count)}
+    finally: os.chdir(oldDir)
+
+def run_all(quick=False):
+    if quick: repeat,count = 1,100
+    else: repeat,count = 3,1000
+    rand = random.Random(42)
+    tmpDir = tempfile.mkdtemp()
+    realStderr,sys.stderr = sys.stderr,StringIO.StringIO() # lexconvert's warnings about the random input would swamp the output
+    try:
+        results = {}
+        results.update(bench_import(repeat))
+        results.update(bench_dictionaries(repeat))
+        results.update(bench_convert(rand,repeat,count))
+        results.update(bench_oed(rand,repeat,count))
+        results.update(bench_festival(rand,tmpDir,repeat,count*20))
+        results.update(bench_lexicon(rand,tmpDir,repeat,count))
+    finally:
+        sys.stderr = realStderr
+        shutil.rmtree(tmpDir)
+    ret = {}
+    for name,(seconds,items) in results.items():
+        ret[name] = {"seconds":seconds,"items":items,"per_second":items/max(seconds,1e-9)}
+    return {"python":sys.version.split()[0],"quick":quick,"benchmarks":ret}
+
+def compare(results,baseline,threshold):
+    # Writes a comparison to standard error, and returns the names of benchmarks that are slower than the baseline by more than threshold percent
+    slower = []
+    for name in sorted(results["benchmarks"].keys()):
+        if not name in baseline["benchmarks"]: continue
+        old = baseline["benchmarks"][name]["per_second"]
+        new = results["benchmarks"][name]["per_second"]
+        change = (new/old-1)*100
+        if change < -threshold: slower.append(name) ; flag = "  SLOWER"
+        else: flag = ""
+        sys.stderr.write("%-50s %12.1f/s %12.1f/s %+7.1f%%%s\n" % (name,old,new,change,flag))
+    return slower
+
+def get_arg(name,default=None):
+    if not name in sys.argv: return default
+    try: return sys.argv[sys.argv.index(name)+1]
+    except IndexError:
+        sys.stderr.write("Error: %s must be followed by a value\n" % name) ; sys.exit(1)
+
+def main():
+    results = run_all('--quick' in sys.argv)
+    out = json.dumps(results,indent=1,sort_keys=True)
+    print out
+    saveFile = get_arg('--save')
+    if saveFile: open(saveFile,"w").write(out+"\n")
+    baselineFile = get_arg('--baseline')
+    if baselineFile:
+        baseline = json.load(open(baselineFile))
+        if baseline.get("quick")!=results["quick"]: sys.stderr.write("Warning: comparing a --quick run with a full one\n")
+        if compare(results,baseline,float(get_arg('--threshold',10))): sys.exit(1)
+
+if __name__ == "__main__": main()
@@ -46,7 +46,7 @@ table = [
    (0, 'A:', 0, 0, 0, ':', 0, '1', 0, 0, u'\u02d0'),
    (0, 0, 0, 0, 0, 'A:', 0, 'AA', 0, 0, u'\u0251\u02d0'),
    (0, 0, 0, 0, 0, 'Ar\\', 0, 0, 0, 0, u'\u0251\u0279'),
-   (0, 0, 0, 0, 'aa', 'a:', 0, 0, 0, 0, 'a\\u02d0'),
+   (0, 0, 0, 0, 'aa', 'a:', 0, 0, 0, 0, u'a\u02d0'),
    ('a', ['a', '&'], 'ae', 'ae', 'AE', '{', '{', 'AE', 'ae', 'AE', [u'\xe6','a']),
    ('uh', 'V', 'ah', 'ah', 'UX', 'V', 'V', 'AH', 'ah', 'OH', u'\u028c'),
    ('o', '0', 'ao', 'oa', 'AA', 'Q', 'Q', 'AA', 'ao', 'O', u'\u0252'),
@@ -144,9 +144,8 @@ formats_where_space_separates_words = ["espeak","mac","unicode-ipa","x-sampa","b
 
 espeak_consonants = "bdDfghklmnNprsStTvwjzZ"
 
-import commands,sys,re,os
-
-for row in table: assert len(row)==len(table[0]) # sanity-check the table
+import sys,re,os,marshal,time,atexit,array,itertools,thread
+# (threading, subprocess, hashlib, collections etc are imported where they're used, so they don't slow down startup)
 
 def compare_tables(table1,table2,colsToIgnore):
   # Debug function to compare 2 versions of the table
@@ -160,21 +159,28 @@ def compare_tables(table1,table2,colsToIgnore):
     if col not in table2[0]: print "Deleted column:",col
   for col in table2[0]:
     if col not in table1[0]: print "Added column:",col
-  maps = [{}, {}]
+  # Both tables' symbols are numbered in one pool, so mappings can be compared as sets of number pairs
+  pool = SymbolPool()
+  ids = [table_columns(table1,pool), table_columns(table2,pool)]
+  nulls = set([i for i,symbol in enumerate(pool.symbols) if not symbol]) # don't bother reporting mappings involving null strings - they don't matter
+  maps = [{}, {}] # (col1,col2) -> set of (symbol number in col1, symbol number in col2)
   commonCols = filter(lambda x:x in table2[0],table1[0])
   for dx in [0,1]:
     table = [table1,table2][dx]
     for col1 in commonCols:
       if col1 in colsToIgnore: continue
-      i1 = list(table[0]).index(col1)
+      ids1 = ids[dx][list(table[0]).index(col1)]
       for col2 in filter(lambda x: x>col1, commonCols):
         if col2 in colsToIgnore: continue
-        i2 = list(table[0]).index(col2)
-        for row in table[1:]:
-          if not row[i1] or not row[i2]: continue # don't bother reporting mappings involving null strings - they don't matter
-          maps[dx][(col1,row[i1],col2,row[i2])] = True
-  deleted_mappings = filter(lambda k:not maps[1].has_key(k), maps[0].keys())
-  added_mappings = filter(lambda k:not maps[0].has_key(k), maps[1].keys())
+        ids2 = ids[dx][list(table[0]).index(col2)]
+        maps[dx][(col1,col2)] = set([(i1,i2) for i1,i2 in zip(ids1,ids2) if not i1 in nulls and not i2 in nulls])
+  def mappings_only_in(m1,m2):
+    ret = []
+    for (col1,col2),pairs in m1.items():
+      for i1,i2 in pairs - m2.get((col1,col2),set()): ret.append((col1,pool.symbols[i1],col2,pool.symbols[i2]))
+    return ret
+  deleted_mappings = mappings_only_in(maps[0],maps[1])
+  added_mappings = mappings_only_in(maps[1],maps[0])
   def simplify_mappings(mappings,which):
     byRow = {} ; byCol = {}
     for k1,v1,k2,v2 in mappings:
@@ -231,29 +237,53 @@ def squash_table(colsToDelete):
   for r in ret: print "   "+repr(r)+","
   print "]"
 
-# Deal with any rows that contain lists of alternatives
-# or 0 (ditto) marks
-# If multiple lists in a row e.g. ([ab],[cd]), give [(a,c), (b,c), (a,d)], as (b,d) would never be reached anyway.
-# (Removing duplicates and redundant rows is not really necessary but may help debugging)
-newTable=[] ; hadAlready = {}
-prevLine = None
-for line in table:
-  line=list(line)
-  for i in range(len(line)):
-    if line[i]==0: line[i]=prevLine[i]
-  line=tuple(line)
-  colsWithLists = filter(lambda col: type(line[col])==type([]), range(len(line)))
-  if not colsWithLists: newTable.append(line)
-  for col in colsWithLists:
-    def firstItemIfList(l):
-      if type(l)==type([]): return l[0]
-      else: return l
-    for extraTuple in [tuple(map(lambda x:firstItemIfList(x),list(line[:col])+[i]+list(line[col+1:]))) for i in line[col]]:
-      if hadAlready.has_key(extraTuple): continue
-      hadAlready[extraTuple]=1
-      newTable.append(extraTuple)
-  prevLine = line
-table = newTable
+def expand_table(table,sourceRows=None):
+  # Deal with any rows that contain lists of alternatives
+  # or 0 (ditto) marks
+  # (If sourceRows is a list, the number of the row in 'table' that each new row came from is appended to it.)
+  # If multiple lists in a row e.g. ([ab],[cd]), give [(a,c), (b,c), (a,d)], as (b,d) would never be reached anyway.
+  # (Removing duplicates and redundant rows is not really necessary but may help debugging)
+  for row in table: assert len(row)==len(table[0]) # sanity-check the table
+  newTable=[] ; hadAlready = {}
+  prevLine = None
+  for lineNo,line in enumerate(table):
+    line=list(line)
+    for i in range(len(line)):
+      if line[i]==0: line[i]=prevLine[i]
+    line=tuple(line)
+    colsWithLists = filter(lambda col: type(line[col])==type([]), range(len(line)))
+    if not colsWithLists:
+      newTable.append(line)
+      if not sourceRows==None: sourceRows.append(lineNo)
+    for col in colsWithLists:
+      def firstItemIfList(l):
+        if type(l)==type([]): return l[0]
+        else: return l
+      for extraTuple in [tuple(map(lambda x:firstItemIfList(x),list(line[:col])+[i]+list(line[col+1:]))) for i in line[col]]:
+        if hadAlready.has_key(extraTuple): continue
+        hadAlready[extraTuple]=1
+        newTable.append(extraTuple)
+        if not sourceRows==None: sourceRows.append(lineNo)
+    prevLine = line
+  # unicode-ipa symbols are kept NFC-normalised, as decode_unicode_ipa makes its input
+  # (only symbols with combining marks can change, so unicodedata is needed only if there are any)
+  col = list(table[0]).index("unicode-ipa")
+  if [row for row in newTable if type(row[col])==unicode and [c for c in row[col] if 0x300<=ord(c)<0x370 or 0x1dc0<=ord(c)<0x1e00 or 0x20d0<=ord(c)<0x2100 or 0xfe20<=ord(c)<0xfe30]]:
+    import unicodedata
+    newTable = [row[:col]+(unicodedata.normalize('NFC',row[col]),)+row[col+1:] if type(row[col])==unicode else row for row in newTable]
+  return newTable
+
+# OED's ALT-text symbols that differ from eSpeak's, and what they are in eSpeak
+oed_alt_symbols = {
+  "{lsyllab}":"l", "{msyllab}":"m", "{nsyllab}":"n",
+  "{zh}":"Z", "{edh}":"D", "{ng}":"N", "{sh}":"S", "{vdftheta}":"T", "{lbelt}":"L",
+  "{shtu}":"U", "{fata}":"A", "{lm}":":", "{shti}":"I", "{ope}":"E", "{schwa}":"@",
+  "{recv}":"O", "{rfa}":"0", "{revv}":"V", "{rfatilde}":"0~", "{sm}":"'", "{smm}":",",
+  "\xe6":"a" }
+oed_alt_symbol_pattern = r"\{[a-z]+\}|\xe6"
+# Markers of variable pronunciation, and the 2 things each can be
+oed_alt_variants = [("',","'",","), # ', can be either primary or secondary stress
+                    ("{shtibar}","I","@"), ("{shtubar}","U","@")]
 
 def OED_alt_to_espeak(oed_alt):
     # Converts values of ALT attributes from OED website into eSpeak.
@@ -266,34 +296,27 @@ def OED_alt_to_espeak(oed_alt):
     # however espeak can correct this by itself so we don't have to.  But do be careful if
     # converting directly to another format - run though espeak -x first, or improve
     # convert(), or add stress-mark-move-forward code to this function.)
-    oed_alt = oed_alt.replace("{lsyllab}","l") \
-    .replace("{msyllab}","m") \
-    .replace("{nsyllab}","n") \
-    .replace("{zh}","Z").replace("{edh}","D").replace("{ng}","N") \
-    .replace("{sh}","S").replace("{vdftheta}","T").replace("{lbelt}","L") \
-    .replace("{shtu}","U").replace("{fata}","A").replace("{lm}",":") \
-    .replace("{shti}","I").replace("{ope}","E").replace("{schwa}","@") \
-    .replace("{recv}","O").replace("{rfa}","0").replace("{revv}","V") \
-    .replace("{rfatilde}","0~").replace("{sm}","'").replace("{smm}",",") \
-    .replace("VI","aI").replace('\xe6','a').strip()
+    oed_alt = re.sub(oed_alt_symbol_pattern,lambda m:oed_alt_symbols.get(m.group(),m.group()),oed_alt) \
+    .replace("VI","aI").strip() # (VI can also come from {revv}{shti}, so it's done afterwards)
     ret = []
-    def add(word):
+    def variants(word):
         if word.startswith("(") and word.endswith(")"): word=word[1:-1] # some entries have ()s around them
         # TODO if there is more instance than one of each type of variable pronunciation in the word, do we want to add ALL combinations?
         # currently just vary all-or-nothing, to give a general idea of the variability
-        if "'," in word: return add(word.replace("',","'")),add(word.replace("',",",")) # ', can be either primary or secondary stress
-        if "{shtibar}" in word: return add(word.replace("{shtibar}","I")),add(word.replace("{shtibar}","@"))
-        if "{shtubar}" in word: return add(word.replace("{shtubar}","U")),add(word.replace("{shtubar}","@"))
-        if "(" in word and ")" in word: return add(word.replace("(","",1).replace(")","",1)), add(word[:word.index("(")]+word[word.index(")")+1:])
-        for c in word:
-            found = False
-            for t in table[1:]:
-                if c in t[1]:
-                    found = True ; break
-            if not found:
-                sys.stderr.write("NB omitting "+repr(word)+" because it still contains unknown characters (e.g. '"+c+"')\n")
-                return
-        ret.append(word)
+        for marker,alt1,alt2 in oed_alt_variants:
+            if marker in word: return variants(word.replace(marker,alt1)) + variants(word.replace(marker,alt2))
+        i = word.find("(") ; j = word.find(")",i+1)
+        if i>-1 and j>-1: return variants(word[:i]+word[i+1:j]+word[j+1:]) + variants(word[:i]+word[j+1:]) # with and without the bracketed part
+        return [word]
+    def add(word):
+        vs = variants(word)
+        if not set("".join(vs)).difference(espeak_symbol_chars): # (the usual case - check them all in one go)
+            ret.extend(vs) ; return
+        for v in vs:
+            unknown = set(v).difference(espeak_symbol_chars)
+            if unknown:
+                sys.stderr.write("NB omitting "+repr(v)+" because it still contains unknown characters (e.g. '"+[c for c in v if c in unknown][0]+"')\n")
+            else: ret.append(v)
     to_add = [] ; adding=False
     if not '/' in oed_alt:
         sys.stderr.write("Warning: no / found, assuming entire input is one pronunciation entry\n")
@@ -307,80 +330,300 @@ def OED_alt_to_espeak(oed_alt):
     if to_add: sys.stderr.write("Warning: unterminated word (did you include both the starting and the ending slashes?)\n")
     return ret
 
-cached_source,cached_dest,cached_dict = None,None,None
-def make_dictionary(source,dest):
-    global cached_source,cached_dest,cached_dict
-    if (source,dest) == (cached_source,cached_dest): return cached_dict
+def build_dictionary(source,dest):
+    # Returns (dictionary, dest_consonants, dest_syllable_sep) for converting from source to dest.
+    # Works on the symbol numbers from intern_table, and the strings it returns are the pool's
+    # (so all the converters share one copy of each symbol).
     types = list(table[0])
-    assert source in types,"Unknown synthesizer name to convert from"
-    assert dest in types, "Unknown synthesizer name to convert to"
-    source,dest = types.index(source), types.index(dest)
-    d = {}
-    global dest_consonants ; dest_consonants = []
-    global dest_syllable_sep ; dest_syllable_sep = table[1][dest]
-    for l in table[1:]:
-        if not d.has_key(l[source]): d[l[source]]=l[dest]
-        is_in_espeak_consonants=True
-        for cTest in l[1]:
-            if cTest not in espeak_consonants:
-                is_in_espeak_consonants=False; break
-        if is_in_espeak_consonants: dest_consonants.append(l[dest])
-    cached_source,cached_dest,cached_dict=source,dest,d
-    return d
+    pool,ids,espeak_consonant_rows = intern_table()
+    sourceIds,destIds = ids[types.index(source)], ids[types.index(dest)]
+    symbols = pool.symbols
+    ids = dict(zip(reversed(sourceIds),reversed(destIds))) # (reversed so the first row with each source symbol wins)
+    d = dict([(symbols[k],symbols[v]) for k,v in ids.iteritems()])
+    return d, [symbols[destIds[i]] for i in espeak_consonant_rows], symbols[destIds[0]]
+
+class SymbolPool(object):
+    # Each distinct symbol of the table once, numbered in order of first appearance.
+    # (str and unicode symbols are kept apart, even if they compare equal.)
+    def __init__(self): self.symbols = [] ; self.ids = {}
+    def id(self,symbol):
+        key = (symbol.__class__,symbol)
+        try: return self.ids[key]
+        except KeyError:
+            self.ids[key] = len(self.symbols) ; self.symbols.append(symbol)
+            return self.ids[key]
+
+def table_columns(table,pool):
+    # Returns, for each column of the table, an array of its rows' symbol numbers in pool (not including the header row)
+    return [array.array('i',[pool.id(row[col]) for row in table[1:]]) for col in xrange(len(table[0]))]
+
+class Converter(object):
+    # Everything convert() needs for one (source,dest) pair: the dictionary, its
+    # longest-match trie, dest's consonants and dest's syllable separator.
+    # Treat as read-only: one instance is shared by every caller (and thread)
+    # converting between the same two formats.
+    # r_coloured is the source symbols that are a shorter symbol followed by an r (x-sampa Er\\,
+    # sapi 'eh r' etc): convert() doesn't take those when a vowel follows, as the r is then a real /r/.
+    __slots__ = ["source","dest","dictionary","trie","consonants","syllable_sep","r_coloured"]
+    def __init__(self,source,dest):
+        types = list(table[0])
+        assert source in types,"Unknown synthesizer name to convert from"
+        assert dest in types, "Unknown synthesizer name to convert to"
+        self.source,self.dest = source,dest
+        self.dictionary, consonants, self.syllable_sep = build_dictionary(source,dest)
+        self.consonants = frozenset(consonants)
+        self.trie = make_trie(self.dictionary)
+        self.r_coloured = frozenset([symbol for symbol in self.dictionary if re.search(u"\\S\\s*(r\\\\|r|\u0279)$",symbol) and [i for i in xrange(1,len(symbol)) if self.dictionary.has_key(symbol[:i])]])
+
+class LRUCache(object):
+    # A bounded mapping that forgets its least recently used entries.  Can be shared between threads.
+    def __init__(self,maxsize):
+        self.maxsize = maxsize
+        self.entries = None ; self.lock = thread.allocate_lock() # (entries is made when first needed, as importing collections slows down startup)
+        self.hits = self.misses = self.evictions = 0
+    def get(self,key,make):
+        # Returns the entry for key, calling make() to create it if it's not there.
+        # make() is called without holding the lock, so other threads aren't held up by it
+        # (if two threads miss the same key at once, both make it, and the value made last is kept).
+        self.lock.acquire()
+        try:
+            if self.entries==None:
+                from collections import OrderedDict
+                self.entries = OrderedDict()
+            try:
+                value = self.entries.pop(key)
+                self.entries[key] = value ; self.hits += 1
+                return value
+            except KeyError: self.misses += 1
+        finally: self.lock.release()
+        value = make()
+        self.lock.acquire()
+        try:
+            self.entries.pop(key,None)
+            self.trim(self.maxsize-1)
+            self.entries[key] = value
+            return value
+        finally: self.lock.release()
+    def trim(self,size):
+        while self.entries and len(self.entries) > size:
+            self.entries.popitem(last=False) ; self.evictions += 1
+    def resize(self,maxsize):
+        self.lock.acquire()
+        try:
+            self.maxsize = maxsize
+            self.trim(maxsize)
+        finally: self.lock.release()
+    def stats(self):
+        return {"size":len(self.entries or ()),"maxsize":self.maxsize,"hits":self.hits,"misses":self.misses,"evictions":self.evictions}
+
+max_cached_converters = 32
+converters = LRUCache(max_cached_converters)
+def get_converter(source,dest): return converters.get((source,dest),lambda:Converter(source,dest))
+
+def prewarm_converters(pairs=None):
+    # Builds the converters for the given (source,dest) pairs (default all of them), e.g. before starting
+    # a long-running job that switches between formats.  Enlarges the cache if they wouldn't all fit.
+    if pairs==None: pairs = [(source,dest) for source in table[0] for dest in table[0]]
+    if len(pairs) > converters.maxsize: converters.resize(len(pairs))
+    for source,dest in pairs: get_converter(source,dest)
+
+def make_dictionary(source,dest): return get_converter(source,dest).dictionary
+
+def make_trie(dictionary):
+    # Compiles a dictionary into a character trie for convert()'s longest-match tokenizer.
+    # Each node is a dict of next-character -> node; node[None] is the value of the symbol that ends there.
+    trie = {}
+    for symbol,value in dictionary.items():
+        if not symbol: continue
+        node = trie
+        for c in symbol: node = node.setdefault(c,{})
+        node[None] = value
+    return trie
+
+table_source_rows = [] # for each row of the expanded table, its row number in the table above (the heading being row 0)
+table = expand_table(table,table_source_rows)
+# The table's symbols, interned in a pool, and each column as an array of their numbers,
+# from which build_dictionary makes the dictionaries for each pair of formats.  They're made
+# when the first converter is built (not on import) and kept as one tuple, so threads can't see half of them.
+interned_table = None
+def intern_table():
+    # Returns (pool of the table's symbols, each column's symbol numbers, the rows that are espeak consonants)
+    global interned_table
+    if not interned_table:
+        pool = SymbolPool()
+        interned_table = (pool, table_columns(table,pool), [i for i,row in enumerate(table[1:]) if not [c for c in row[1] if c not in espeak_consonants]])
+    return interned_table
+espeak_symbol_chars = frozenset("".join([row[1] for row in table[1:]])) # for checking OED input
+
+# convert() can also remember its results, for callers that convert the same words
+# over and over: use set_conversion_cache_size (or --cache-size N) to turn this on.
+conversion_cache = None
+
+def set_conversion_cache_size(size):
+    # Remember up to 'size' convert() results (0 to stop remembering them)
+    global conversion_cache
+    if not size: conversion_cache = None
+    elif conversion_cache: conversion_cache.resize(size)
+    else: conversion_cache = LRUCache(size)
+
+def conversion_cache_stats():
+    # Returns a dict of the conversion cache's size, maxsize, hits, misses and evictions (or None if it's off)
+    if conversion_cache: return conversion_cache.stats()
 
 def convert(pronunc,source,dest):
-    if source=="unicode-ipa":
-        # try to decode it
-        if "\\u" in pronunc and not '"' in pronunc: # maybe \uNNNN copied from Gecko on X11, can just evaluate it to get the unicode
-            # (NB make sure to quote the \'s if pasing in on the command line)
-            try: pronunc=eval('u"'+pronunc+'"')
-            except: pass
-        else: # see if it makes sense as utf-8
-            try: pronunc = pronunc.decode('utf-8')
-            except: pass
+    cache = conversion_cache
+    if not cache: return convert_uncached(pronunc,source,dest)
+    return cache.get((pronunc,source,dest),lambda:convert_uncached(pronunc,source,dest))
+
+# unicode-ipa input can come as UTF-8, as \uNNNN escapes (e.g. copied from Gecko on X11; NB quote
+# the \'s if passing them on the command line), or as unicode already, and the same symbol can be
+# precomposed or decomposed.  decode_unicode_ipa turns any of these into NFC-normalised unicode (as the
+# table's column is), once per stream or batch where possible (convert_phones_stream, convert_many)
+# rather than once per word.  Precomposed characters that aren't in the table (e.g. a nasal or
+# tone-marked vowel) are then decomposed again, so the vowel is still found and only the mark is unknown.
+unicode_escape_pattern = r'\\u([0-9a-fA-F]{4})'
+unicode_ipa_decompositions = None # code point -> its NFD, for precomposed characters not in the table
+
+def decompose_unknown(text):
+    global unicode_ipa_decompositions
+    import unicodedata
+    if unicode_ipa_decompositions==None:
+        col = list(table[0]).index("unicode-ipa") ; known = set()
+        for row in table[1:]:
+            if type(row[col])==unicode: known.update(row[col])
+        d = {}
+        for c in xrange(0xc0,0x2000): # (the Latin, Greek and Cyrillic blocks, and Latin Extended Additional)
+            if not unichr(c) in known and unicodedata.decomposition(unichr(c))[:1] not in ["","<"]: d[c] = unicodedata.normalize('NFD',unichr(c))
+        unicode_ipa_decompositions = d
+    return text.translate(unicode_ipa_decompositions)
+
+def decode_unicode_ipa(text):
+    import unicodedata
+    if type(text)==str:
+        try: text = text.decode('utf-8')
+        except UnicodeDecodeError: text = text.decode('latin-1') # (not UTF-8, so assume an 8-bit IPA font's encoding)
+    if u"\\u" in text: text = re.sub(unicode_escape_pattern,lambda m:unichr(int(m.group(1),16)),text)
+    return decompose_unknown(unicodedata.normalize('NFC',text))
+
+def decode_unicode_ipa_many(pronuncs):
+    # Decodes a list of pronunciations in one go (joined as rewrite_many does)
+    import unicodedata
+    if not pronuncs or [p for p in pronuncs if "\n" in p]: return map(decode_unicode_ipa,pronuncs)
+    types = set(map(type,pronuncs))
+    if types==set([unicode]): text = u"\n".join(pronuncs) # (e.g. already decoded by convert_phones_stream)
+    elif types==set([str]):
+        try: text = "\n".join(pronuncs).decode('utf-8')
+        except UnicodeDecodeError: return map(decode_unicode_ipa,pronuncs) # (one by one then, so only those that aren't UTF-8 are read as 8-bit)
+    else: return map(decode_unicode_ipa,pronuncs)
+    if u"\\u" in text: return map(decode_unicode_ipa,text.split(u"\n")) # (an escape could be a \n)
+    return decompose_unknown(unicodedata.normalize('NFC',text)).split(u"\n")
+
+def vowel_follows(converter,pronunc,pos):
+    # Whether the next phoneme from pos on (after any stress marks and syllable separators) converts to a vowel
+    end = len(pronunc)
+    while pos < end:
+        if pronunc[pos].isspace():
+            pos += 1 ; continue
+        node = converter.trie ; nextPos = pos ; matchEnd = None
+        while nextPos < end:
+            node = node.get(pronunc[nextPos])
+            if node==None: break
+            nextPos += 1
+            if node.has_key(None): matchEnd, value = nextPos, node[None].split()
+        if matchEnd==None: return False
+        if value and not value[0]==converter.syllable_sep and not value[0] in u"',\u02c8\u02cc" and not (value[0] in ['0','1','2'] and not converter.dest=="espeak"): return not value[0] in converter.consonants
+        pos = matchEnd
+    return False
+
+def convert_uncached(pronunc,source,dest):
+    if source=="unicode-ipa" and not type(pronunc)==unicode: pronunc = decode_unicode_ipa(pronunc) # (normally done by the caller, once for a whole batch)
     ret = [] ; toAddAfter = None
-    dictionary = make_dictionary(source,dest)
-    while pronunc:
-        for lettersToTry in [2,1,0]:
-            if not lettersToTry and source=="espeak": sys.stderr.write("Warning: ignoring unknown espeak phoneme "+repr(pronunc[0])+"\n")
-            if not lettersToTry: pronunc=pronunc[1:] # ignore
-            elif dictionary.has_key(pronunc[:lettersToTry]):
-                toAdd=dictionary[pronunc[:lettersToTry]]
-                if toAdd in ['0','1','2'] and not dest=="espeak": # it's a stress mark in a notation that places stress marks AFTER vowels (not dest=="espeak" added because espeak uses 0 for other purposes)
-                    if dest=="bbcmicro": # not sure which pitch levels to map the stresses to; try these:
-                      if toAdd=='1': toAdd='3'
-                      elif toAdd=='2': toAdd='4'
-                    if source in ["espeak","unicode-ipa"]: # stress should be moved from before the vowel to after it
-                        toAdd, toAddAfter = "",toAdd
-                    else:
-                        # With Cepstral synth, stress mark should be placed EXACTLY after the vowel and not any later.  Might as well do this for others also.
-                        # (not dest=="espeak" because that uses 0 as a phoneme; anyway it's dealt with separately below)
-                        r=len(ret)-1
-                        while ret[r] in dest_consonants or ret[r].endswith("*added"): r -= 1 # (if that raises IndexError then the input had a stress mark before any vowel) ("*added" condition is there so that implicit vowels don't get the stress)
-                        ret.insert(r+1,toAdd) ; toAdd=""
-                elif toAdd in u"',\u02c8\u02cc" and dest in ["espeak","unicode-ipa"] and not source in ["espeak","unicode-ipa"]: # it's a stress mark that should be moved from after the vowel to before it
-                    i=len(ret)
-                    while i and (ret[i-1] in dest_consonants or ret[i-1].endswith("*added")): i -= 1
-                    if i: i-=1
-                    ret.insert(i,toAdd)
-                    toAdd = ""
-                # attempt to sort out the festival dictionary's (and other's) implicit @ :
-                if ret and ret[-1] and toAdd in ['n','l'] and ret[-1] in dest_consonants: ret.append(dictionary['@']+'*added')
-                elif len(ret)>2 and ret[-2].endswith('*added') and toAdd and not toAdd in dest_consonants and not toAdd==dest_syllable_sep: del ret[-2]
-                # OK, add it:
-                if toAdd:
-                    toAdd=toAdd.split()
-                    ret.append(toAdd[0])
-                    if toAddAfter and not toAdd[0] in dest_consonants:
-                        ret.append(toAddAfter)
-                        toAddAfter=None
-                    ret += toAdd[1:]
-                    # TODO: the above few lines make sure that toAddAfter goes after the FIRST phoneme if toAdd is multiple phonemes, but works only when converting from eSpeak to non-eSpeak; it ought to work when converting from non-eSpeak to non-eSpeak also (doesn't matter when converting TO eSpeak)
-                if source=="espeak" and pronunc[:lettersToTry]=="e@" and len(pronunc)>lettersToTry and pronunc[lettersToTry]=="r" and (len(pronunc)==lettersToTry+1 or pronunc[lettersToTry+1] in espeak_consonants): lettersToTry += 1 # hack because the 'r' is implicit in other synths (but DO have it if there's another vowel to follow)
-                pronunc=pronunc[lettersToTry:]
-                break
+    # Stress marks that have to go before/after an earlier phoneme are kept in
+    # before[i]/after[i] rather than inserted into the middle of ret, and lastVowel
+    # is the index of the last item in ret that isn't a consonant or an implicit
+    # "*added" vowel (i.e. where a stress mark would go), so neither needs a scan.
+    before = {} ; after = {} ; inserted = 0 ; lastVowel = None
+    converter = get_converter(source,dest)
+    dictionary, trie = converter.dictionary, converter.trie
+    dest_consonants, dest_syllable_sep = converter.consonants, converter.syllable_sep
+    pos = 0 ; end = len(pronunc)
+    while pos < end:
+        # find the longest symbol (of any length) that starts at pos
+        node = trie ; nextPos = pos ; matchEnd = toAdd = None
+        while nextPos < end:
+            node = node.get(pronunc[nextPos])
+            if node==None: break
+            nextPos += 1
+            if node.has_key(None): shorterEnd, shorterAdd, matchEnd, toAdd = matchEnd, toAdd, nextPos, node[None]
+        if matchEnd==None:
+            if source=="espeak": sys.stderr.write("Warning: ignoring unknown espeak phoneme "+repr(pronunc[pos])+"\n")
+            elif source=="unicode-ipa" and not pronunc[pos].isspace(): sys.stderr.write("Warning: ignoring unknown unicode-ipa character %s (U+%04X)\n" % (repr(pronunc[pos]),ord(pronunc[pos])))
+            pos += 1 ; continue # ignore
+        if shorterEnd and pronunc[pos:matchEnd] in converter.r_coloured and vowel_follows(converter,pronunc,matchEnd): matchEnd, toAdd = shorterEnd, shorterAdd # (the r starts the next syllable, so take it separately)
+        if toAdd in ['0','1','2'] and not dest=="espeak": # it's a stress mark in a notation that places stress marks AFTER vowels (not dest=="espeak" added because espeak uses 0 for other purposes)
+            if dest=="bbcmicro": # not sure which pitch levels to map the stresses to; try these:
+              if toAdd=='1': toAdd='3'
+              elif toAdd=='2': toAdd='4'
+            if source in ["espeak","unicode-ipa"]: # stress should be moved from before the vowel to after it
+                toAdd, toAddAfter = "",toAdd
+            else:
+                # With Cepstral synth, stress mark should be placed EXACTLY after the vowel and not any later.  Might as well do this for others also.
+                # (not dest=="espeak" because that uses 0 as a phoneme; anyway it's dealt with separately below)
+                # ("*added" vowels are skipped so that implicit vowels don't get the stress)
+                if lastVowel==None: raise IndexError("stress mark before any vowel")
+                if lastVowel==len(ret)-1:
+                    ret.append(toAdd)
+                    if not toAdd in dest_consonants: lastVowel += 1
+                else: # after the vowel and after any (non-consonant) stress marks already there
+                    marks = after.setdefault(lastVowel,[])
+                    i = len(marks)
+                    while i and marks[i-1] in dest_consonants: i -= 1
+                    marks.insert(i,toAdd) ; inserted += 1
+                toAdd=""
+        elif toAdd in u"',\u02c8\u02cc" and dest in ["espeak","unicode-ipa"] and not source in ["espeak","unicode-ipa"]: # it's a stress mark that should be moved from after the vowel to before it
+            if not ret:
+                ret.append(toAdd)
+                if not toAdd in dest_consonants: lastVowel = 0
+            elif lastVowel==None: # no vowel yet: goes at the start, before the last (non-consonant) stress mark already there
+                marks = before.setdefault(0,[])
+                i = len(marks)
+                while i and marks[i-1] in dest_consonants: i -= 1
+                if i: i -= 1
+                marks.insert(i,toAdd) ; inserted += 1
+            else:
+                before.setdefault(lastVowel,[]).append(toAdd) ; inserted += 1
+            toAdd = ""
+        # attempt to sort out the festival dictionary's (and other's) implicit @ :
+        if ret and ret[-1] and toAdd in ['n','l'] and ret[-1] in dest_consonants: ret.append(dictionary['@']+'*added')
+        elif len(ret)+inserted>2 and len(ret)>1 and ret[-2].endswith('*added') and not before.has_key(len(ret)-1) and not after.has_key(len(ret)-2) and toAdd and not toAdd in dest_consonants and not toAdd==dest_syllable_sep:
+            del ret[-2]
+            if lastVowel==len(ret): lastVowel -= 1
+            if before.has_key(len(ret)): before[len(ret)-1] = before.pop(len(ret))
+            if after.has_key(len(ret)): after[len(ret)-1] = after.pop(len(ret))
+        # OK, add it:
+        if toAdd:
+            toAdd=toAdd.split()
+            ret.append(toAdd[0])
+            if not toAdd[0] in dest_consonants: lastVowel = len(ret)-1
+            if toAddAfter and not toAdd[0] in dest_consonants:
+                ret.append(toAddAfter)
+                if not toAddAfter in dest_consonants: lastVowel = len(ret)-1
+                toAddAfter=None
+            for t in toAdd[1:]:
+                ret.append(t)
+                if not t in dest_consonants: lastVowel = len(ret)-1
+            # TODO: the above few lines make sure that toAddAfter goes after the FIRST phoneme if toAdd is multiple phonemes, but works only when converting from eSpeak to non-eSpeak; it ought to work when converting from non-eSpeak to non-eSpeak also (doesn't matter when converting TO eSpeak)
+        if source=="espeak" and pronunc[pos:matchEnd]=="e@" and matchEnd<end and pronunc[matchEnd]=="r" and (matchEnd+1==end or pronunc[matchEnd+1] in espeak_consonants): matchEnd += 1 # hack because the 'r' is implicit in other synths (but DO have it if there's another vowel to follow)
+        pos = matchEnd
     if toAddAfter: ret.append(toAddAfter)
-    if ret[-1]==dest_syllable_sep: del ret[-1] # spurious syllable separator at end
+    if before or after:
+        withMarks = []
+        for i in xrange(len(ret)):
+            if before.has_key(i): withMarks += before[i]
+            withMarks.append(ret[i])
+            if after.has_key(i): withMarks += after[i]
+        ret = withMarks
+    if ret and ret[-1]==dest_syllable_sep: del ret[-1] # spurious syllable separator at end
     if dest in formats_where_space_separates_words: separator = ''
     else: separator = ' '
     ret=separator.join(ret).replace('*added','')
@@ -388,77 +631,566 @@ def convert(pronunc,source,dest):
     if dest=="espeak": return cleanup_espeak_entry(ret)
     else: return ret
 
-def cleanup_espeak_entry(r):
-    r = r.replace("k'a2n","k'@n").replace("ka2n","k@n").replace("gg","g")
-    if r.endswith("i@r"): return r[:-3]+"i@"
-    if r.endswith("U@r"): return r[:-3]+"U@"
-    elif r.endswith("@r") and not r.endswith("e@r"): return r[:-2]+"3"
-    if r.endswith("A:r"): return r[:-3]+"A@"
-    if r.endswith("O:r"): return r[:-3]+"O@"
-    if r.endswith("@l") and not r.endswith("i@l") and not r.endswith("U@l"): return r[:-2]+"@L"
-    if r.endswith("rr") or r.endswith("3:r"): return r[:-1]
+def convert_many(pronuncs,source,dest):
+    # Converts a batch of pronunciations, converting each distinct one only once (wordlists
+    # repeat the same forms a lot).  Takes any iterable and returns a list in the same order,
+    # or takes a NumPy array and returns an array of the same shape.
+    if type(pronuncs).__module__=="numpy": # (NumPy is needed only if you pass it arrays)
+        import numpy
+        unique,inverse = numpy.unique(pronuncs,return_inverse=True)
+        return numpy.array(convert_many(unique.tolist(),source,dest),dtype=object)[inverse].reshape(pronuncs.shape)
+    if source=="unicode-ipa": pronuncs = decode_unicode_ipa_many(list(pronuncs))
+    converted = {} ; ret = []
+    for pronunc in pronuncs:
+        if not converted.has_key(pronunc): converted[pronunc] = convert(pronunc,source,dest)
+        ret.append(converted[pronunc])
+    return ret
+
+# Rewrite rules are written as tables.  A list of (old,new) replacements is done in order
+# (as a chain of .replace() calls would be).  rewrite_many does them to a whole list of
+# pronunciations at once, joined into one string, so each rule is one pass over all of them
+# (much quicker than word by word; nothing in the rules involves "\n", so entries can't affect each other).
+# Suffix rules are made into one regular expression with a dict saying what each suffix becomes:
+# the longest suffix that the string ends with applies (new=None means leave the string alone).
+# (Regular expressions are compiled when they're first used, through re's cache, rather than on import.)
+
+def rewrite(rules,s):
+    for old,new in rules: s = s.replace(old,new)
+    return s
+
+def rewrite_many(rules,strings):
+    if not strings: return []
+    return rewrite(rules,"\n".join(strings)).split("\n")
+
+def compile_suffix_rules(rules):
+    return "(?:"+"|".join([re.escape(suffix) for suffix,new in rules])+")$", dict(rules), max([len(suffix) for suffix,new in rules])
+
+def rewrite_suffix((pattern,replacements,maxLen),s):
+    m = re.compile(pattern).search(s,max(0,len(s)-maxLen)) # (the leftmost match is the longest suffix)
+    if m and not replacements[m.group()]==None: return s[:m.start()]+replacements[m.group()]
+    return s
+
+espeak_cleanup_rules = [("k'a2n","k'@n"),("ka2n","k@n"),("gg","g")]
+espeak_cleanup_suffixes = compile_suffix_rules([
+    ("i@r","i@"), ("U@r","U@"), ("e@r",None), ("@r","3"),
+    ("A:r","A@"), ("O:r","O@"),
+    ("i@l",None), ("U@l",None), ("@l","@L"),
+    ("rr","r"), ("3:r","3:")])
     # TODO: 'declared' & 'declare' the 'r' after the 'E' sounds a bit 'regional' (but pretty).  but sounds incomplete w/out 'r', and there doesn't seem to be an E2 or E@
     # TODO: consider adding 'g' to words ending in 'N' (if want the 'g' pronounced in '-ng' words) (however, careful of words like 'yankee' where the 'g' would be followed by a 'k'; this may also be a problem going into the next word)
-    return r
+
+def cleanup_espeak_entry(r): return rewrite_suffix(espeak_cleanup_suffixes,rewrite(espeak_cleanup_rules,r))
+
+# Differences between eSpeak pronunciations that espeak_probably_right_already ignores
+espeak_simplify_rules = [
+    (";",""), ("%",""),
+    ("a2","@"),
+    ("3","@"),
+    ("L","l"),
+    ("I2","i:"),
+    ("I","i:"), ("i@","i:@"),
+    (",",""),
+    ("s","z"),
+    ("aa","A:"),
+    ("A@","A:"),
+    ("O@","O:"),
+    ("o@","O:"),
+    ("r-","r")]
+    # TODO: rewrite @ to 3 whenever not followed by a vowel?
 
 def espeak_probably_right_already(existing_pronunc,new_pronunc):
     # Compares our "new" pronunciation with eSpeak's existing pronunciation.  As our transcription into eSpeak notation is only approximate, it could be that our new pronunciation is not identical to the existing one but the existing one is actually correct.
     if existing_pronunc==new_pronunc: return True
-    def simplify(pronunc): return \
-        pronunc.replace(";","").replace("%","") \
-        .replace("a2","@") \
-        .replace("3","@") \
-        .replace("L","l") \
-        .replace("I2","i:") \
-        .replace("I","i:").replace("i@","i:@") \
-        .replace(",","") \
-        .replace("s","z") \
-        .replace("aa","A:") \
-        .replace("A@","A:") \
-        .replace("O@","O:") \
-        .replace("o@","O:") \
-        .replace("r-","r")
-    # TODO: rewrite @ to 3 whenever not followed by a vowel?
-    if simplify(existing_pronunc)==simplify(new_pronunc): return True # almost the same, and festival @/a2 etc seems to be a bit ambiguous so leave it alone
+    if rewrite(espeak_simplify_rules,existing_pronunc)==rewrite(espeak_simplify_rules,new_pronunc): return True # almost the same, and festival @/a2 etc seems to be a bit ambiguous so leave it alone
+
+def espeak_probably_right_already_many(existing_pronuncs,new_pronuncs):
+    # espeak_probably_right_already for two lists at once (e.g. to compare whole lexicons); returns a list of True/False
+    return [e==n or se==sn for e,n,se,sn in zip(existing_pronuncs,new_pronuncs,rewrite_many(espeak_simplify_rules,existing_pronuncs),rewrite_many(espeak_simplify_rules,new_pronuncs))]
+
+festival_pos = frozenset(['n','v','a','cc','dt','in','j','k','nil','prp','uh']) # (anything else is two or more words)
+
+def parse_festival_line(line):
+    # Returns (word, pos, pronunc) from a line of the Festival OALD file, or None if it isn't a one-word entry
+    line=line.strip()
+    if "((pos" in line: line=line[:line.index("((pos")]
+    if line.startswith('( "'): line=line[3:]
+    try:
+        word, pos, pronunc = line.translate(None,'"()').split(None,2)
+    except ValueError: return None # malformed line
+    if pos not in festival_pos: return None
+    return (word.lower(), pos, pronunc)
+
+def map_file(fname):
+    # Returns a read-only memory map of the file (or "" if it's empty, as that can't be mapped)
+    import mmap
+    f = open(fname,"rb")
+    try:
+        if not os.fstat(f.fileno()).st_size: return ""
+        return mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    finally: f.close() # (the map stays valid)
+
+def festival_lines(m):
+    # Yields (byte offset, line) for each line of a mapped file
+    start = 0 ; end = len(m)
+    while start < end:
+        nl = m.find("\n",start)
+        if nl==-1: nl = end
+        yield start, m[start:nl]
+        start = nl+1
+
+def festival_entry_at(m,offset):
+    nl = m.find("\n",offset)
+    if nl==-1: nl = len(m)
+    return parse_festival_line(m[offset:nl])
 
 def parse_festival_dict(festival_location):
+    for offset,line in festival_lines(map_file(festival_location)):
+        entry = parse_festival_line(line)
+        if entry: yield entry
+
+# A word -> byte offsets index of the OALD file is kept in the home directory, so later
+# runs and single-word lookups needn't read the whole file again.  Set festival_index_prefix to None to disable.
+festival_index_prefix = os.path.expanduser("~/.lexconvert-oald-")
+def festival_index_file(festival_location):
+    import hashlib
+    if not festival_index_prefix: return None
+    return festival_index_prefix+hashlib.md5(os.path.abspath(festival_location)).hexdigest()[:12]
+
+def festival_index(festival_location):
+    # Returns {word: [byte offsets of its entries]} for the OALD file
+    st = os.stat(festival_location)
+    key = (os.path.abspath(festival_location),st.st_size,st.st_mtime,st.st_ino) # (the inode changes if the file is replaced)
+    indexFile = festival_index_file(festival_location)
+    if indexFile:
+        try:
+            savedKey,index = marshal.load(open(indexFile,"rb"))
+            if savedKey==key: return index
+        except: pass # not indexed yet (or the file has changed)
+    index = {}
+    for offset,line in festival_lines(map_file(festival_location)):
+        entry = parse_festival_line(line)
+        if entry: index.setdefault(entry[0],[]).append(offset)
+    if indexFile:
+        try:
+            tmp = indexFile+".%d" % os.getpid()
+            f = open(tmp,"wb") ; marshal.dump((key,index),f) ; f.close()
+            os.rename(tmp,indexFile)
+        except (IOError,OSError): pass
+    return index
+
+def lookup_festival_word(festival_location,word):
+    # Returns the (word, pos, pronunc) entries for one word, using the index
+    m = map_file(festival_location)
+    return [festival_entry_at(m,offset) for offset in festival_index(festival_location).get(word.lower(),[])]
+
+class EspeakBatch(object):
+    # One batch of lines queued on an EspeakPool; result() waits for its phonemes
+    def __init__(self,lines,raw=False):
+        import threading
+        self.lines,self.raw = lines,raw ; self.done = threading.Event()
+        self.phonemes = self.error = None
+    def result(self):
+        self.done.wait()
+        if self.error: raise self.error
+        return self.phonemes
+
+class EspeakPool(object):
+    # Text-to-phoneme conversion through up to 'size' espeak processes at once, without a
+    # shared temporary file.  Lines are sent in batches, and each result is matched to its
+    # line by position (if espeak's output for a batch doesn't have one line per input line,
+    # the batch is split until it does, so one odd word can't shift all the others).
+    # (A raw batch, as for --phones, just gets all of espeak's output lines, with no matching up.)
+    # espeak writes its -x output reliably only when its input is closed, so each batch gets
+    # its own espeak process; the pool's worker threads live as long as the pool does, so
+    # batches can be submitted from anywhere and run side by side.
+    def __init__(self,size=1,command="espeak -q -x -v en-rp",batch_size=500,clause_separator=" "):
+        import threading,Queue
+        self.command,self.batch_size,self.clause_separator = command,batch_size,clause_separator
+        self.queue = Queue.Queue() ; self.threads = []
+        for i in xrange(max(1,size)):
+            t = threading.Thread(target=self.worker) ; t.setDaemon(True) ; t.start()
+            self.threads.append(t)
+    def close(self):
+        for t in self.threads: self.queue.put(None)
+        for t in self.threads: t.join()
+        self.threads = []
+    def worker(self):
+        while True:
+            batch = self.queue.get()
+            if batch==None: return
+            try:
+                if batch.raw: batch.phonemes = self.run_raw(batch.lines)
+                else: batch.phonemes = self.run(batch.lines)
+            except Exception, e: batch.error = e
+            batch.done.set()
+    def run_raw(self,lines):
+        # One espeak run over all of 'lines'; returns its (non-blank) output lines
+        import subprocess
+        proc = subprocess.Popen(self.command,shell=True,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out,err = proc.communicate("".join([l+"\n" for l in lines]))
+        out = [l.strip() for l in out.split("\n") if l.strip()]
+        if proc.returncode and not out: raise OSError("'%s' failed: %s" % (self.command,err.strip()))
+        return out
+    def run(self,lines):
+        out = self.run_raw(lines)
+        if len(out)==len(lines): return out
+        if len(lines)==1:
+            if not out: sys.stderr.write("Warning: espeak gave no phonemes for %s\n" % repr(lines[0]))
+            return [self.clause_separator.join(out)] # (espeak gave more than one line, e.g. one per clause)
+        return self.run(lines[:len(lines)/2]) + self.run(lines[len(lines)/2:])
+    def submit(self,lines,raw=False):
+        batch = EspeakBatch(lines,raw) ; self.queue.put(batch) ; return batch
+    def phonemes(self,lines,show_progress=False):
+        # Returns espeak's phonemes for each of 'lines' (a list), in the same order
+        batches = [self.submit(lines[i:i+self.batch_size]) for i in xrange(0,len(lines),self.batch_size)]
+        ret = []
+        for b in batches:
+            ret += b.result()
+            if show_progress: sys.stdout.write(str(int(len(ret)*100/len(lines)))+"%\r") ; sys.stdout.flush()
+        if show_progress: print
+        return ret
+
+# Server mode (--server): keeps the converters warm and answers JSON requests over a
+# local socket, one per line.  Requests that arrive together are handled together
+# by a RequestBatcher, so concurrent callers share conversions and espeak runs.
+
+class PendingRequest(object):
+    def __init__(self,request):
+        import threading
+        self.request = request ; self.done = threading.Event()
+        self.response = None
+    def result(self):
+        self.done.wait()
+        if isinstance(self.response,Exception): raise self.response
+        return self.response
+
+class RequestBatcher(object):
+    # Passes requests from any number of threads to process(list of requests) on one worker thread.
+    # Whatever requests arrive while it's busy are done together next time, so nothing waits
+    # for a batch to fill up.  process returns a response (or Exception) for each request.
+    def __init__(self,process):
+        import threading,Queue
+        self.process = process ; self.queue = Queue.Queue()
+        t = threading.Thread(target=self.worker) ; t.setDaemon(True) ; t.start()
+    def call(self,request):
+        pending = PendingRequest(request) ; self.queue.put(pending)
+        return pending.result()
+    def worker(self):
+        import Queue
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while True: batch.append(self.queue.get_nowait())
+            except Queue.Empty: pass
+            try: responses = self.process([p.request for p in batch])
+            except Exception, e: responses = [e]*len(batch)
+            for p,r in zip(batch,responses):
+                p.response = r ; p.done.set()
+
+def convert_requests(requests):
+    # process function for a RequestBatcher of (words,source,dest) requests: the words of all
+    # requests for the same pair are converted together (so forms they share are converted once)
+    from collections import OrderedDict
+    byPair = OrderedDict()
+    for i,(words,source,dest) in enumerate(requests): byPair.setdefault((source,dest),[]).append(i)
+    responses = [None]*len(requests)
+    for (source,dest),indices in byPair.items():
+        try:
+            converted = convert_many([w for i in indices for w in requests[i][0]],source,dest) ; pos = 0
+            for i in indices:
+                responses[i] = converted[pos:pos+len(requests[i][0])] ; pos += len(requests[i][0])
+        except Exception: # redo them one request at a time, so a bad word fails only its own request
+            for i in indices:
+                try: responses[i] = convert_many(requests[i][0],source,dest)
+                except Exception, e: responses[i] = e
+    return responses
+
+class ConversionService(object):
+    # What the server does with each request: {"source":..,"dest":..,"words":[..]} converts the words,
+    # and {"dest":..,"text":".."} gets the text's phonemes from espeak and converts those
+    def __init__(self,jobs=1):
+        self.espeak = EspeakPool(jobs)
+        self.converter = RequestBatcher(convert_requests)
+        self.texts = RequestBatcher(lambda texts:self.espeak.phonemes(texts))
+    def answer(self,request):
+        if not type(request)==dict: raise ValueError("request should be a JSON object")
+        source,dest = request.get("source","espeak"),request.get("dest")
+        for fmt in [source,dest]:
+            if not fmt in table[0]: raise ValueError("unknown format %s" % repr(fmt))
+        if request.has_key("text"):
+            if not source=="espeak": raise ValueError("a text request's source is always espeak (it's espeak that reads the text)")
+            words = self.texts.call(" ".join(unicode(request["text"]).encode("utf-8").split())).split()
+        else: words = [unicode(w).encode("utf-8") for w in request.get("words",[])]
+        return self.converter.call((words,source,dest))
+    def close(self): self.espeak.close()
+
+def handle_connection(rfile,wfile,service):
+    # Reads requests (a line of JSON each) until the client closes the connection, and answers each with
+    # a line of JSON: {"results":[..]} or {"error":".."}
+    import json
+    while True:
+        line = rfile.readline()
+        if not line: break
+        try: response = {"results":service.answer(json.loads(line))}
+        except Exception, e: response = {"error":str(e) or e.__class__.__name__}
+        wfile.write(json.dumps(response)+"\n") ; wfile.flush()
+
+def serve(address,jobs=1):
+    # Serves requests on 127.0.0.1:address if address is a port number, otherwise on a Unix socket at address
+    import SocketServer,socket,stat
+    service = ConversionService(jobs)
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            if self.connection.family==socket.AF_INET: self.connection.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1) # (don't hold up small responses)
+            handle_connection(self.rfile,self.wfile,service)
+    if str(address).isdigit():
+        class Server(SocketServer.ThreadingMixIn,SocketServer.TCPServer): daemon_threads = allow_reuse_address = True
+        server = Server(("127.0.0.1",int(address)),Handler)
+    else:
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode): os.remove(address) # left over from last time
+        class Server(SocketServer.ThreadingMixIn,SocketServer.UnixStreamServer): daemon_threads = True
+        server = Server(address,Handler)
+    prewarm_converters()
+    sys.stderr.write("Serving on %s\n" % (address,))
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally:
+        server.server_close() ; service.close()
+        if not str(address).isdigit(): os.remove(address)
+
+# Profiling: --profile (or enable_profiling()) records the calls, items, wall-clock time and
+# CPU time of each stage of the work, and prints a summary at exit.  Functions named in
+# profiled_functions are wrapped only when profiling is enabled, and the other stages are
+# marked with 'with profile_stage(...)', which does nothing until then, so there's no cost otherwise.
+# Hooks added with add_profile_hook are called with (stage, items, wall, cpu) as each stage finishes.
+profiling = False
+profile_stats = None # stage -> [calls, items, wall seconds, CPU seconds], in order (made by enable_profiling)
+profile_hooks = []
+profiled_functions = ["convert","convert_many","convert_in_parallel","espeak_probably_right_already","espeak_probably_right_already_many","parse_festival_dict","festival_index","convert_user_lexicon","phones_stream"]
+
+class profile_stage(object):
+    __slots__ = ["name","items","start"]
+    def __init__(self,name,items=1): self.name,self.items,self.start = name,items,None
+    def __enter__(self):
+        if profiling: self.start = (time.time(),time.clock())
+    def __exit__(self,*args):
+        if self.start: record_stage(self.name,self.items,time.time()-self.start[0],time.clock()-self.start[1])
+
+def record_stage(name,items,wall,cpu):
+    stats = profile_stats.setdefault(name,[0,0,0.0,0.0])
+    stats[0] += 1 ; stats[1] += items ; stats[2] += wall ; stats[3] += cpu
+    for hook in profile_hooks: hook(name,items,wall,cpu)
+
+def profiled(name,func):
+    # Returns a version of func that records its calls under 'name'.  Items are the length of a list
+    # passed as the first argument (e.g. a batch of pronunciations), or 1 per call; generators count what they yield.
+    if func.func_code.co_flags & 0x20: # CO_GENERATOR (not using inspect, as importing it would slow down startup)
+        def wrapper(*args,**kw):
+            gen = func(*args,**kw) ; items = 0 ; wall = cpu = 0.0
+            while True:
+                t,c = time.time(),time.clock()
+                try: x = gen.next()
+                except StopIteration: break
+                finally: wall += time.time()-t ; cpu += time.clock()-c
+                items += 1 ; yield x
+            record_stage(name,items,wall,cpu)
+    else:
+        def wrapper(*args,**kw):
+            if args and type(args[0])==list: items = len(args[0])
+            else: items = 1
+            t,c = time.time(),time.clock()
+            try: return func(*args,**kw)
+            finally: record_stage(name,items,time.time()-t,time.clock()-c)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+def add_profile_hook(hook):
+    profile_hooks.append(hook) ; enable_profiling()
+
+def enable_profiling(cprofile_file=None,summary=True):
+    # Turns on stage timing (with a summary on stderr at exit if summary is True),
+    # and if cprofile_file is set, also runs cProfile and dumps its stats there at exit
+    global profiling,profile_stats
+    if not profiling:
+        from collections import OrderedDict
+        profile_stats = OrderedDict() ; profiling = True
+        for name in profiled_functions: globals()[name] = profiled(name,globals()[name])
+        if summary: atexit.register(print_profile_summary)
+    if cprofile_file:
+        import cProfile
+        profiler = cProfile.Profile() ; profiler.enable()
+        def dump():
+            profiler.disable() ; profiler.dump_stats(cprofile_file)
+            sys.stderr.write("cProfile stats written to %s\n" % cprofile_file)
+        atexit.register(dump)
+
+def print_profile_summary(outFile=None):
+    if not outFile: outFile = sys.stderr
+    outFile.write("%-40s %8s %10s %10s %10s %12s\n" % ("Stage","Calls","Items","Wall (s)","CPU (s)","Items/s"))
+    for name,(calls,items,wall,cpu) in profile_stats.items():
+        outFile.write("%-40s %8d %10d %10.3f %10.3f %12.1f\n" % (name,calls,items,wall,cpu,items/max(wall,1e-9)))
+
+def convert_chunk((pronuncs,source,dest)): return [convert(p,source,dest) for p in pronuncs] # (module-level so a process pool can call it)
+
+def convert_in_parallel(pronuncs,source,dest,jobs,pool=None):
+    # Converts a list of pronunciations using 'jobs' processes; results are in the same order as pronuncs.
+    # (Pass a multiprocessing pool of that size to use it, rather than starting one for this call.)
+    if jobs<=1 or len(pronuncs)<2: return convert_chunk((pronuncs,source,dest))
+    chunkSize = max(1,len(pronuncs)/(jobs*4)) # several chunks per process, to even out the load
+    chunks = [(pronuncs[i:i+chunkSize],source,dest) for i in xrange(0,len(pronuncs),chunkSize)]
+    if pool: chunks = pool.map(convert_chunk,chunks)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try: chunks = pool.map(convert_chunk,chunks)
+        finally: pool.close() ; pool.join()
     ret = []
-    for line in open(festival_location).xreadlines():
-        line=line.strip()
-        if "((pos" in line: line=line[:line.index("((pos")]
-        if line.startswith('( "'): line=line[3:]
-        line=line.replace('"','').replace('(','').replace(')','')
+    for c in chunks: ret += c
+    return ret
+
+# Table checks for maintainers (--check-table): which rows each symbol is in, which symbols
+# each conversion can never produce, and which conversions don't survive a round trip.
+
+def table_index():
+    # For each format, symbol -> the numbers of the (expanded) table rows that have it, in order
+    index = {} ; pool,ids,ignore = intern_table()
+    for col,fmt in enumerate(table[0]):
+        symbols = pool.symbols ; rows = {}
+        for row,i in enumerate(ids[col]): rows.setdefault(symbols[i],[]).append(row+1)
+        index[fmt] = rows
+    return index
+
+def source_rows(rows):
+    # The numbers of the rows of the table as written (not expanded) that the given expanded rows came from
+    return sorted(set([table_source_rows[r] for r in rows]))
+
+def table_report(index=None):
+    # For each format, returns (ambiguous, unproducible, unmatchable), with row numbers as in the table as written:
+    # ambiguous = {symbol: rows} for symbols in more than one row where those rows disagree about other formats
+    # (alternatives listed within one row don't count: only the first of those is used, as unproducible shows);
+    # unproducible = {dest: [(symbol, rows)]} for the dest symbols that converting from this format to dest can never
+    # give, because build_dictionary keeps only the first row for each symbol and no row that is used gives them;
+    # unmatchable = rows with an empty symbol in this format (convert() can never match those).
+    if index==None: index = table_index()
+    report = {}
+    for col,fmt in enumerate(table[0]):
+        ambiguous = {} ; shadowed = [] ; unmatchable = []
+        produced = set() # (dest column, symbol) given by the rows that are used
+        for symbol,rows in index[fmt].items():
+            if not symbol:
+                unmatchable += rows ; continue
+            first = table[rows[0]]
+            for c in xrange(len(first)): produced.add((c,first[c]))
+            differing = [r for r in rows[1:] if [c for c in xrange(len(first)) if not c==col and not table[r][c]==first[c]]]
+            if differing:
+                shadowed += differing
+                if len(source_rows(rows[:1]+differing))>1: ambiguous[symbol] = source_rows(rows)
+        unproducible = {}
+        for c,dest in enumerate(table[0]):
+            if c==col: continue
+            rows = {} ; symbols = []
+            for r in sorted(shadowed):
+                symbol = table[r][c]
+                if (c,symbol) in produced: continue
+                if not rows.has_key(symbol): symbols.append(symbol)
+                rows.setdefault(symbol,[]).append(r)
+            if symbols: unproducible[dest] = [(symbol,source_rows(rows[symbol])) for symbol in symbols]
+        report[fmt] = (ambiguous,unproducible,source_rows(unmatchable))
+    return report
+
+def round_trip_corpus():
+    # For each format, a pronunciation of each of its symbols (except empty ones)
+    return dict([(fmt,[symbol for symbol in rows.keys() if symbol]) for fmt,rows in table_index().items()])
+
+def round_trip_pair((source,dest,pronuncs)):
+    # Converts pronuncs from source to dest and back, and returns (original, via dest, back) for the ones that don't come back the same
+    mismatches = []
+    for pronunc in pronuncs:
         try:
-            word, pos, pronunc = line.split(None,2)
-        except ValueError: continue # malformed line
-        if pos not in ['n','v','a','cc','dt','in','j','k','nil','prp','uh']: continue # two or more words
-        yield (word.lower(), pos, pronunc)
+            there = convert(pronunc,source,dest)
+            back = convert(there,dest,source)
+        except Exception, e: there,back = None,"%s: %s" % (e.__class__.__name__,e)
+        if not back==pronunc: mismatches.append((pronunc,there,back))
+    return mismatches
+
+def round_trip_check(corpus=None,jobs=1):
+    # Round-trips corpus (format -> list of pronunciations in it; default round_trip_corpus())
+    # through every other format, using 'jobs' processes; returns {(source,dest): mismatches}
+    if corpus==None: corpus = round_trip_corpus()
+    work = [(source,dest,corpus[source]) for source in table[0] for dest in table[0] if not source==dest and corpus.get(source)]
+    if jobs<=1: results = map(round_trip_pair,work)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try: results = pool.map(round_trip_pair,work)
+        finally: pool.close() ; pool.join()
+    return dict([((source,dest),r) for (source,dest,p),r in zip(work,results)])
+
+def check_table(corpusFormat=None,corpusFile=None,jobs=1,examples=3):
+    # Prints the table report and the round-trip results.  If corpusFile is given, its
+    # pronunciations (one per line, in corpusFormat) are converted into each format and added to the corpus.
+    report = table_report()
+    for fmt in table[0]:
+        ambiguous,unproducible,unmatchable = report[fmt]
+        print "%s: %d ambiguous symbol%s, %d row%s with no symbol (%s)" % (fmt,len(ambiguous),"s"[:len(ambiguous)!=1],len(unmatchable),"s"[:len(unmatchable)!=1],", ".join(map(str,unmatchable)) or "none")
+        for symbol in sorted(ambiguous.keys()): print "  %s is in row%s %s" % (repr(symbol),"s"[:len(ambiguous[symbol])-1],", ".join(map(str,ambiguous[symbol])))
+        for dest in table[0]:
+            if unproducible.get(dest): print "  converting to %s, these can never be produced: %s" % (dest,", ".join(["%s (row%s %s)" % (repr(symbol),"s"[:len(rows)-1],", ".join(map(str,rows))) for symbol,rows in unproducible[dest]]))
+    corpus = round_trip_corpus()
+    if corpusFile:
+        words = [l.strip() for l in open(corpusFile) if l.strip()]
+        for fmt in table[0]: corpus[fmt] = corpus[fmt] + convert_many(words,corpusFormat,fmt)
+    print
+    for (source,dest),mismatches in sorted(round_trip_check(corpus,jobs).items()):
+        if not mismatches: continue
+        print "%s -> %s -> %s: %d of %d don't come back the same, e.g. %s" % (source,dest,source,len(mismatches),len(corpus[source]),"; ".join(["%s -> %s -> %s" % tuple(map(repr,m)) for m in mismatches[:examples]]))
+
+# The manifest remembers, for each Festival entry, what it was converted to and what eSpeak
+# said about it, so that re-runs need to convert and check only the entries that changed.
+# Entries are keyed by a hash of the word, its Festival pronunciation and everything else the
+# result depends on (festival_manifest_hash: the table, the eSpeak rewrite rules and
+# festival_manifest_version), so editing the table, the rules or the OALD file invalidates just what it affects.
+# Delete en_extra.manifest to force everything to be redone (e.g. after upgrading eSpeak).
+festival_manifest_file = "en_extra.manifest"
+festival_manifest_version = 1 # increase this if a change to the conversion code changes its results
+def festival_manifest_hash():
+    import hashlib
+    pattern,replacements,maxLen = espeak_cleanup_suffixes
+    return hashlib.md5(repr((festival_manifest_version,table,espeak_cleanup_rules,pattern,sorted(replacements.items()),espeak_simplify_rules))).digest()
+def festival_manifest_key(word,pronunc,tableHash):
+    import hashlib ; return hashlib.md5(word+"\0"+pronunc+"\0"+tableHash).digest()
+
+def load_manifest(fname):
+    try: return marshal.load(open(fname,"rb"))
+    except: return {} # no manifest (or unreadable) - start from scratch
+
+def save_manifest(fname,manifest):
+    try:
+        tmp = fname+".%d" % os.getpid()
+        f = open(tmp,"wb") ; marshal.dump(manifest,f) ; f.close()
+        os.rename(tmp,fname)
+    except (IOError,OSError): sys.stderr.write("Warning: could not write "+fname+"\n")
+
+festival_chunk_size = 10000 # words converted (and checked with espeak) at a time
 
-def convert_system_festival_dictionary_to_espeak(festival_location,check_existing_pronunciation,add_user_dictionary_also):
+def convert_system_festival_dictionary_to_espeak(festival_location,check_existing_pronunciation,add_user_dictionary_also,jobs=1):
     os.system("mv en_extra en_extra~") # start with blank 'extra' dictionary
-    if check_existing_pronunciation: os.system("espeak --compile=en") # so that the pronunciation we're checking against is not influenced by a previous version of en_extra
-    outFile=open("en_extra","w")
+    open("en_extra","w").close()
+    outFile=open("en_extra.new","w") # (en_extra stays blank until all the chunks are done, as espeak may be compiled to check existing pronunciations after the first chunk is written)
+    oldManifest = load_manifest(festival_manifest_file) ; manifest = {} ; tableHash = festival_manifest_hash()
     print "Reading dictionary lists"
     wordDic = {} ; ambiguous = {}
     for line in filter(lambda x:x.split() and not re.match(r'^[a-z]* *\$',x),open("en_list").read().split('\n')): ambiguous[line.split()[0]]=ambiguous[line.split()[0]+'s']=True # this stops the code below from overriding anything already in espeak's en_list.  If taking out then you need to think carefully about words like "a", "the" etc.
-    for word,pos,pronunc in parse_festival_dict(festival_location):
+    # wordDic maps each word to the offset of its entry in the (mapped) OALD file, rather than holding all the entries in memory
+    for word,offsets in festival_index(festival_location).iteritems():
+        if len(offsets)==1 and not ambiguous.has_key(word): wordDic[word] = offsets[0] # (words with more than one entry are ambiguous - better not go there)
+    festival = map_file(festival_location)
+    def festival_pronunc(word):
+        pronunc = festival_entry_at(festival,wordDic[word])[2]
         pronunc=pronunc.replace("i@ 0 @ 0","ii ou 2 ").replace("i@ 0 u 0","ii ou ") # (hack for OALD's "radio"/"video"/"stereo"/"embryo" etc)
-        pronunc=pronunc.replace("0","") # 0's not necessary, and OALD sometimes puts them in wrong places, confusing the converter
-        if wordDic.has_key(word):
-            ambiguous[word] = True
-            del wordDic[word] # better not go there
-        if not ambiguous.has_key(word):
-            wordDic[word] = (pronunc, pos)
-    toDel = []
-    if check_existing_pronunciation:
-        print "Checking existing pronunciation"
-        proc=os.popen("espeak -q -x -v en-rp > /tmp/.pronunc 2>&1","w")
-        wList = []
-    progressCount=0
-    for word,(pronunc,pos) in wordDic.items():
-        if check_existing_pronunciation:
-            sys.stdout.write(str(int(progressCount*100/len(wordDic)))+"%\r") ; sys.stdout.flush()
-            progressCount += 1
+        return pronunc.replace("0","") # 0's not necessary, and OALD sometimes puts them in wrong places, confusing the converter
+    toDel = [] ; oldPronDic = {}
+    for word in wordDic.keys():
         if not re.match("^[A-Za-z-]*$",word):
             # contains special characters - better not go there
             toDel.append(word)
@@ -466,99 +1198,523 @@ def convert_system_festival_dictionary_to_espeak(festival_location,check_existin
             # unnecessary plural (espeak will pick up on them anyway)
             toDel.append(word)
         elif word.startswith("year") or "quarter" in word: toDel.append(word) # don't like festival's pronunciation of those (TODO: also 'memorial' why start with [m'I])
-        elif check_existing_pronunciation:
-            proc.write(word+"\n")
-            proc.flush() # so the progress indicator works
-            wList.append(word)
-    if check_existing_pronunciation:
-        proc.close() ; print
-        oldPronDic = {}
-        for k,v in zip(wList,open("/tmp/.pronunc").read().split("\n")): oldPronDic[k]=v.strip().replace(" ","")
     for w in toDel: del wordDic[w]
+    if check_existing_pronunciation: espeak = EspeakPool(jobs) ; compiled = False
+    pool = None
+    if jobs>1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
     print "Doing the conversion"
     lines_output = 0
     total_lines = 0
     not_output_because_ok = []
-    items = wordDic.items() ; items.sort() # necessary because of the hacks below which check for the presence of truncated versions of the word (want to have decided whether or not to output those truncated versions before reaching the hacks)
-    for word,(pronunc,pos) in items:
-        total_lines += 1
-        new_e_pronunc = convert(pronunc,"festival","espeak")
-        if new_e_pronunc.count("'")==2 and not '-' in word: new_e_pronunc=new_e_pronunc.replace("'",",",1) # if 2 primary accents then make the first one a secondary (except on hyphenated words)
-        # TODO if not en-rp? - if (word.endswith("y") or word.endswith("ie")) and new_e_pronunc.endswith("i:"): new_e_pronunc=new_e_pronunc[:-2]+"I"
-        unrelated_word = None
-        if check_existing_pronunciation: espeakPronunc = oldPronDic.get(word,"")
-        else: espeakPronunc = ""
-        if word[-1]=='e' and wordDic.has_key(word[:-1]): unrelated_word, espeakPronunc = word[:-1],"" # hack: if word ends with 'e' and dropping the 'e' leaves a valid word that's also in the dictionary, we DON'T want to drop this word on the grounds that espeak already gets it right, because if we do then adding 's' to this word may cause espeak to add 's' to the OTHER word ('-es' rule).
-        if espeak_probably_right_already(espeakPronunc,new_e_pronunc):
-            not_output_because_ok.append(word)
-            continue
-        if not unrelated_word: lines_output += 1
-        outFile.write(word+" "+new_e_pronunc+" // from Festival's ("+pronunc+")")
-        if espeakPronunc: outFile.write(", not [["+espeakPronunc+"]]")
-        elif unrelated_word: outFile.write(" (here to stop espeak's affix rules getting confused by Festival's \""+unrelated_word+"\")")
-        outFile.write("\n")
+    words = sorted(wordDic.keys()) # necessary because of the hacks below which check for the presence of truncated versions of the word (want to have decided whether or not to output those truncated versions before reaching the hacks)
+    # The words are done festival_chunk_size at a time, in order, so only one chunk's pronunciations are held at once
+    for chunkStart in xrange(0,len(words),festival_chunk_size):
+        chunk = words[chunkStart:chunkStart+festival_chunk_size]
+        pronuncs = [festival_pronunc(word) for word in chunk]
+        keys = [festival_manifest_key(word,pronunc,tableHash) for word,pronunc in zip(chunk,pronuncs)]
+        if check_existing_pronunciation:
+            wList = []
+            for word,k in zip(chunk,keys):
+                cached = oldManifest.get(k)
+                if cached and not cached[1]==None: oldPronDic[word] = cached[1]
+                else: wList.append(word)
+            if wList:
+                if not compiled:
+                    with profile_stage("espeak --compile=en"): os.system("espeak --compile=en") # so that the pronunciation we're checking against is not influenced by a previous version of en_extra (which is now blank)
+                    compiled = True
+                with profile_stage("espeak (existing pronunciations)",len(wList)): phonemes = espeak.phonemes(wList)
+                for w,v in zip(wList,phonemes): oldPronDic[w]=v.replace(" ","")
+        newlyConverted = iter(convert_in_parallel([pronunc for pronunc,k in zip(pronuncs,keys) if not oldManifest.has_key(k)],"festival","espeak",jobs,pool)) # (each entry converts independently; the hacks below are done afterwards, in order)
+        for word,pronunc,k in zip(chunk,pronuncs,keys):
+            total_lines += 1
+            if oldManifest.has_key(k): cached = oldManifest[k]
+            else: cached = (newlyConverted.next(),None,None)
+            new_e_pronunc = cached[0]
+            if new_e_pronunc.count("'")==2 and not '-' in word: new_e_pronunc=new_e_pronunc.replace("'",",",1) # if 2 primary accents then make the first one a secondary (except on hyphenated words)
+            # TODO if not en-rp? - if (word.endswith("y") or word.endswith("ie")) and new_e_pronunc.endswith("i:"): new_e_pronunc=new_e_pronunc[:-2]+"I"
+            unrelated_word = None
+            if check_existing_pronunciation: espeakPronunc = oldPronDic.get(word,"")
+            else: espeakPronunc = ""
+            if word[-1]=='e' and wordDic.has_key(word[:-1]): unrelated_word, espeakPronunc = word[:-1],"" # hack: if word ends with 'e' and dropping the 'e' leaves a valid word that's also in the dictionary, we DON'T want to drop this word on the grounds that espeak already gets it right, because if we do then adding 's' to this word may cause espeak to add 's' to the OTHER word ('-es' rule).
+            if not unrelated_word and cached[1]==oldPronDic.get(word) and not cached[2]==None: ok = cached[2]
+            else: ok = bool(espeak_probably_right_already(espeakPronunc,new_e_pronunc))
+            if unrelated_word: manifest[k] = (cached[0],oldPronDic.get(word),None)
+            else: manifest[k] = (cached[0],oldPronDic.get(word),ok)
+            if ok:
+                    not_output_because_ok.append(word)
+                    continue
+            if not unrelated_word: lines_output += 1
+            outFile.write(word+" "+new_e_pronunc+" // from Festival's ("+pronunc+")")
+            if espeakPronunc: outFile.write(", not [["+espeakPronunc+"]]")
+            elif unrelated_word: outFile.write(" (here to stop espeak's affix rules getting confused by Festival's \""+unrelated_word+"\")")
+            outFile.write("\n")
+        sys.stdout.write(str(int((chunkStart+len(chunk))*100/len(words)))+"%\r") ; sys.stdout.flush()
+    print
+    if pool: pool.close() ; pool.join()
     print "Corrected(?) %d entries out of %d" % (lines_output,total_lines)
+    outFile.close() ; os.rename("en_extra.new","en_extra") ; outFile=open("en_extra","a")
+    save_manifest(festival_manifest_file,manifest)
     if add_user_dictionary_also: convert_user_lexicon("festival","espeak",outFile)
     outFile.close()
-    os.system("espeak --compile=en")
+    with profile_stage("espeak --compile=en"): os.system("espeak --compile=en")
     if not_output_because_ok:
       print "Checking for unwanted side-effects of those corrections" # e.g. terrible as Terr + ible, inducing as in+Duce+ing
-      proc=os.popen("espeak -q -x -v en-rp > /tmp/.pronunc 2>&1","w")
-      progressCount = 0
-      for w in not_output_because_ok:
-          proc.write(w+"\n") ; proc.flush()
-          sys.stdout.write(str(int(progressCount*100/len(not_output_because_ok)))+"%\r") ; sys.stdout.flush()
-          progressCount += 1
-      proc.close()
       outFile=open("en_extra","a") # append to it
-      for word,pronunc in zip(not_output_because_ok,open("/tmp/.pronunc").read().split("\n")):
-        pronunc = pronunc.strip().replace(" ","")
-        if not pronunc==oldPronDic[word] and not espeak_probably_right_already(oldPronDic[word],pronunc):
+      with profile_stage("espeak (side-effect check)",len(not_output_because_ok)): phonemes = [pronunc.replace(" ","") for pronunc in espeak.phonemes(not_output_because_ok,True)]
+      for word,pronunc,ok in zip(not_output_because_ok,phonemes,espeak_probably_right_already_many([oldPronDic[word] for word in not_output_because_ok],phonemes)):
+        if not ok:
           outFile.write(word+" "+oldPronDic[word]+" // (undo affix-side-effect from previous words that gave \""+pronunc+"\")\n")
       outFile.close()
-      os.system("espeak --compile=en")
+      with profile_stage("espeak --compile=en"): os.system("espeak --compile=en")
+    if check_existing_pronunciation: espeak.close()
     return not_output_because_ok
 
+# Readers for user lexicons: each yields (word, pronunciation) as it reads the file
+def read_festival_lexicon(fname):
+    # Reads the (lex.add.entry ...) lines of a .festivalrc, e.g. (lex.add.entry '("hello" n ((h @0) (l ou1))))
+    for line in open(fname):
+        if not line.startswith("(lex.add.entry"): continue
+        m = re.match(r'[^"]*"([^"]*)"\s+\S+\s(.*)$',line.rstrip("\n").split(";")[0])
+        if m: yield m.group(1), re.sub(" +"," ",m.group(2).replace("("," ").replace(")"," "))
+
+def read_espeak_lexicon(fname):
+    for line in open(fname):
+        fields = line.split()[:2]
+        if len(fields)==2: yield fields
+
+def read_cepstral_lexicon(fname):
+    for line in open(fname):
+        if not line.strip(): continue
+        word, ignore, pronunc = line.split(None,2)
+        yield word, pronunc
+
+lexicon_readers = { # (each can be given another file to read instead of the usual one)
+    "festival": lambda fname=None:read_festival_lexicon(fname or os.path.expanduser("~/.festivalrc")),
+    "espeak": lambda fname=None:read_espeak_lexicon(fname or "en_extra"),
+    "cepstral": lambda fname=None:read_cepstral_lexicon(fname or "lexicon.txt")}
+
+# Writers for user lexicons: (header, function to format an entry, footer)
+lexicon_writers = {
+    "espeak": ("", lambda word,pronunc:word+" "+pronunc+"\n", ""),
+    "sapi": ("rem  You have to run this file\nrem  with ptts.exe in the same directory\nrem  to add these words to the SAPI lexicon\n\n", lambda word,pronunc:"ptts -la "+word+" \""+pronunc+"\"\n", ""),
+    "cepstral": ("", lambda word,pronunc:word.lower()+" 0 "+pronunc+"\n", ""),
+    "mac": ("# I don't yet know how to add to the Mac OS X lexicon,\n# so here is a 'sed' command you can run on your text\n# to put the pronunciation inline:\n\nsed", lambda word,pronunc:" -e \"s/"+word+"/[[inpt PHON]]"+pronunc+"[[inpt TEXT]]/g\"", "\n"),
+    "bbcmicro": ("", lambda word,pronunc:"> "+word.upper()+"_"+chr(128)+pronunc, ">**"), # (specifying 'whole word'; remove the space before or the _ after if you want)
+    "unicode-ipa": ("<HTML><HEAD>\n<META HTTP-EQUIV=\"Content-Type\" CONTENT=\"text/html; charset=utf-8\">\n</HEAD><BODY><TABLE>\n", lambda word,pronunc:"<TR><TD>"+word+"</TD><TD>"+pronunc.encode("UTF-8")+"</TD></TR>\n", "</TABLE></BODY></HTML>\n")}
+
+lexicon_chunk_size = 1000 # entries converted (and written) at a time
+
 def convert_user_lexicon(fromFormat,toFormat,outFile):
-    if fromFormat=="festival": lex = eval('['+commands.getoutput("grep '^(lex.add.entry' ~/.festivalrc | sed -e 's/;.*//' -e 's/[^\"]*\"/[\"/' -e 's/\" . /\",(\"/' -e 's/$/\"],/' -e 's/[()]/ /g' -e 's/  */ /g'")+']')
-    elif fromFormat=="espeak": lex = filter(lambda x:len(x)==2,[l.split()[:2] for l in open("en_extra").readlines()])
-    elif fromFormat=="cepstral":
-        lex = []
-        for l in open("lexicon.txt").readlines():
-            word, ignore, pronunc = l.split(None,2)
-            lex.append((word,pronunc))
-    else: assert 0, "Reading from '%s' lexicon file not yet implemented" % (fromFormat,)
-    if toFormat=="mac": outFile.write("# I don't yet know how to add to the Mac OS X lexicon,\n# so here is a 'sed' command you can run on your text\n# to put the pronunciation inline:\n\nsed")
-    elif toFormat=="sapi": outFile.write("rem  You have to run this file\nrem  with ptts.exe in the same directory\nrem  to add these words to the SAPI lexicon\n\n")
-    elif toFormat=="unicode-ipa": outFile.write("<HTML><HEAD>\n<META HTTP-EQUIV=\"Content-Type\" CONTENT=\"text/html; charset=utf-8\">\n</HEAD><BODY><TABLE>\n")
-    for word, pronunc in lex:
-        pronunc = convert(pronunc,fromFormat,toFormat)
-        if toFormat=="espeak": outFile.write(word+" "+pronunc+"\n")
-        elif toFormat=="sapi": outFile.write("ptts -la "+word+" \""+pronunc+"\"\n")
-        elif toFormat=="cepstral": outFile.write(word.lower()+" 0 "+pronunc+"\n")
-        elif toFormat=="mac": outFile.write(" -e \"s/"+word+"/[[inpt PHON]]"+pronunc+"[[inpt TEXT]]/g\"")
-        elif toFormat=="bbcmicro": outFile.write("> "+word.upper()+"_"+chr(128)+pronunc) # (specifying 'whole word'; remove the space before or the _ after if you want)
-        elif toFormat=="unicode-ipa": outFile.write("<TR><TD>"+word+"</TD><TD>"+pronunc.encode("UTF-8")+"</TD></TR>\n")
-        else: assert 0, "Writing to lexicon in %s format not yet implemented" % (format,)
-    if toFormat=="mac": outFile.write("\n")
-    elif toFormat=="bbcmicro": outFile.write(">**")
-    elif toFormat=="unicode-ipa": outFile.write("</TABLE></BODY></HTML>\n")
-
-first_word=True # hack for bbcmicro
-def markup_inline_word(format,pronunc):
-    global first_word
+    # Streams the lexicon through in chunks, so memory use doesn't grow with its size
+    assert lexicon_readers.has_key(fromFormat), "Reading from '%s' lexicon file not yet implemented" % (fromFormat,)
+    assert lexicon_writers.has_key(toFormat), "Writing to lexicon in %s format not yet implemented" % (toFormat,)
+    header,entry,footer = lexicon_writers[toFormat]
+    outFile.write(header)
+    lex = lexicon_readers[fromFormat]()
+    while True:
+        chunk = list(itertools.islice(lex,lexicon_chunk_size))
+        if not chunk: break
+        outFile.write("".join([entry(word,pronunc) for (word,ignore),pronunc in zip(chunk,convert_many([pronunc for word,pronunc in chunk],fromFormat,toFormat))]))
+    outFile.write(footer)
+
+# A homophone index: the words of a lexicon by their pronunciation in eSpeak notation, simplified with
+# espeak_simplify_rules (so words that espeak_probably_right_already would count as pronounced the same
+# have the same key), built in one pass instead of comparing every pair of entries.  For near matches,
+# each key's letter pairs (with ^ and $ at the ends) are indexed: a key within k edits of another
+# shares at least (the longer one's length + 1 - 2k) of them, so only keys that do are compared with levenshtein.
+
+def read_lexicon(format,fname=None):
+    # (word, pronunciation) pairs from a user lexicon (the usual file if fname is None), or from the OALD file if format is "oald"
+    if format=="oald":
+        assert fname, "Reading the OALD lexicon needs the location of its file"
+        return ((word,pronunc) for word,pos,pronunc in parse_festival_dict(fname))
+    assert lexicon_readers.has_key(format), "Reading from '%s' lexicon file not yet implemented" % (format,)
+    return lexicon_readers[format](fname)
+
+def letter_pairs(key):
+    key = "^"+key+"$" ; return [key[i:i+2] for i in xrange(len(key)-1)]
+
+class HomophoneIndex(object):
+    def __init__(self,entries=(),format="espeak"):
+        self.words = {} # key -> words
+        self.keys = [] ; self.pairs = {} ; self.byLength = {} # (numbered keys, letter pair -> key numbers, length -> key numbers)
+        self.add(entries,format)
+    def simplify(self,pronuncs,format="espeak"):
+        if format=="oald": format = "festival"
+        if not format=="espeak": pronuncs = convert_many(pronuncs,format,"espeak")
+        return rewrite_many(espeak_simplify_rules,pronuncs)
+    def add(self,entries,format="espeak"):
+        entries = iter(entries)
+        while True:
+            chunk = list(itertools.islice(entries,lexicon_chunk_size))
+            if not chunk: break
+            for (word,ignore),key in zip(chunk,self.simplify([pronunc for word,pronunc in chunk],format)):
+                if not self.words.has_key(key):
+                    self.words[key] = [] ; n = len(self.keys) ; self.keys.append(key)
+                    for pair in letter_pairs(key): self.pairs.setdefault(pair,[]).append(n)
+                    self.byLength.setdefault(len(key),[]).append(n)
+                if not word in self.words[key]: self.words[key].append(word)
+    def homophones(self,pronunc,format="espeak"):
+        # The words whose pronunciation simplifies to the same as pronunc's
+        return self.words.get(self.simplify([pronunc],format)[0],[])
+    def collisions(self):
+        # [(key, words)] for each key that more than one word has
+        return sorted([(key,words) for key,words in self.words.items() if len(words)>1])
+    def near(self,pronunc,maxDistance=1,format="espeak"):
+        # [(distance, key, words)] for the keys within maxDistance edits of pronunc's, nearest first
+        key = self.simplify([pronunc],format)[0]
+        shared = {} # key number -> letter pairs in common (counting repeats more than once, which only lets more through)
+        for pair in letter_pairs(key):
+            for n in self.pairs.get(pair,()): shared[n] = shared.get(n,0)+1
+        ret = []
+        for length in xrange(max(0,len(key)-maxDistance),len(key)+maxDistance+1):
+            needed = max(len(key),length)+1-2*maxDistance
+            for n in self.byLength.get(length,()):
+                if shared.get(n,0) < needed: continue
+                d = levenshtein(key,self.keys[n])
+                if d <= maxDistance: ret.append((d,self.keys[n],self.words[self.keys[n]]))
+        return sorted(ret)
+
+def report_homophones(format,fname=None,maxDistance=None,inFile=sys.stdin,outFile=sys.stdout):
+    # For --homophones: lists the words that share a simplified pronunciation, or with maxDistance,
+    # reads pronunciations (in 'format') one per line and lists the words within that many edits of each
+    index = HomophoneIndex(read_lexicon(format,fname),format)
+    if maxDistance==None:
+        collisions = index.collisions()
+        for key,words in collisions: outFile.write(key+"\t"+" ".join(words)+"\n")
+        sys.stderr.write("%d simplified pronunciations, of which %d are shared by more than one word\n" % (len(index.keys),len(collisions)))
+        return
+    if inFile.isatty(): sys.stderr.write("Indexed %d simplified pronunciations; type pronunciations (in %s format) one per line to look them up\n" % (len(index.keys),format))
+    for line in iter(inFile.readline,""): # (not 'for line in inFile', which reads ahead)
+        pronunc = line.strip()
+        if not pronunc: continue
+        outFile.write(pronunc+"\t"+", ".join(["%s (%d)" % (word,d) for d,key,words in index.near(pronunc,maxDistance,format) for word in words])+"\n")
+        outFile.flush()
+
+def convert_phones_stream(inFile,outFile,format1,format2):
+    # Converts phones line by line (for --phones2phones with no phones on the command line),
+    # so a whole spreadsheet can go through one process instead of one process per row.
+    # Lines stay aligned with the input, and tab-separated fields stay tab-separated.
+    get_converter(format1,format2) # build it once up-front
+    if format1=="unicode-ipa": inFile = itertools.imap(decode_unicode_ipa,inFile)
+    markup = InlineMarkup(format2)
+    for lineNo,line in enumerate(inFile,1):
+        fields = []
+        for field in line.rstrip("\r\n").split("\t"):
+            if format1 in formats_where_space_separates_words: fields.append(field.split())
+            elif field.strip(): fields.append([field.strip()])
+            else: fields.append([])
+        try: converted = [convert_many([w for words in fields for w in words],format1,format2)] # (columns often repeat the same forms)
+        except IndexError: # e.g. a stress mark before any vowel: redo it field by field, and leave the bad ones blank so the output stays aligned
+            converted = []
+            for n,words in enumerate(fields,1):
+                try: converted.append(convert_many(words,format1,format2))
+                except IndexError, e:
+                    sys.stderr.write("Warning: line %d field %d can't be converted (%s); leaving it blank\n" % (lineNo,n,e))
+                    converted.append([]) ; fields[n-1] = []
+        converted = iter([c for words in converted for c in words])
+        outFile.write("\t".join([" ".join([markup(converted.next()) for w in words]) for words in fields])+"\n")
+
+# --wordlist does the job of the 'conversion' script: map every character of a wordlist
+# (a spreadsheet saved as tab-separated text) through a mapping file such as IPA2XSAMPA.csv,
+# and split the result into RuG/L04 item files as sssplit would.  It streams: each line is
+# checked, converted and written out as it is read.
+
+mapping_line_pattern = r'^"\s*(\S+)\s*"\s+"\s*(\S+)\s*"\s*$'
+
+def read_mapping_file(fname):
+    # Returns a unicode.translate table (code point -> replacement) from lines like "0x0268" "1"
+    table = {ord(u'"'):None} # double quotes delimit wordlist items, so are dropped
+    for lineNo,line in enumerate(open(fname),1):
+        m = re.match(mapping_line_pattern,line.decode('utf-8'),re.UNICODE)
+        if not m:
+            sys.stderr.write("Error: Problem reading line %d of %s: bad format?\n" % (lineNo,fname)) ; sys.exit(1)
+        codepoint,replacement = m.groups()
+        try: c = int(codepoint,16)
+        except ValueError: continue # (the script would never match it either)
+        if "%#06x" % c == codepoint: table[c] = replacement
+    return table
+
+def perl_split(pattern,line):
+    # like Perl's split, drops trailing empty fields (the .converted layout depends on this)
+    fields = re.split(pattern,line)
+    while fields and not fields[-1]: del fields[-1]
+    return fields
+
+# --wordlist's item files (one per item, plus _LABELS_.LBL, as sssplit makes for RuG/L04) are
+# packed into one file, <wordlist>.items, instead of thousands of small ones: the records one after
+# another, then a marshalled index of (name, offset, length), then the index's offset as 8 bytes.
+# ItemPack reads single records through mmap, and --export-items writes out the classic files when they're wanted.
+item_pack_magic = "lexconvert-items 1\n"
+
+class ItemPackWriter(object):
+    def __init__(self,fname):
+        self.f = open(fname,"wb") ; self.f.write(item_pack_magic)
+        from collections import OrderedDict
+        self.index = OrderedDict() ; self.offset = len(item_pack_magic)
+    def add(self,name,data):
+        self.index[name] = (self.offset,len(data)) # (a later record with the same name replaces it, as a file would)
+        self.f.write(data) ; self.offset += len(data)
+    def close(self):
+        self.f.write(marshal.dumps([(name,offset,length) for name,(offset,length) in self.index.items()]))
+        import struct
+        self.f.write(struct.pack("<Q",self.offset)) ; self.f.close()
+
+class ItemPack(object):
+    # item(name) returns the record as a buffer on the mapped file (no copying)
+    def __init__(self,fname):
+        self.map = map_file(fname)
+        if not self.map[:len(item_pack_magic)]==item_pack_magic: raise ValueError("%s is not an item pack" % fname)
+        import struct
+        indexOffset, = struct.unpack("<Q",self.map[-8:])
+        from collections import OrderedDict
+        self.index = OrderedDict([(name,(offset,length)) for name,offset,length in marshal.loads(self.map[indexOffset:-8])])
+    def names(self): return self.index.keys()
+    def item(self,name):
+        offset,length = self.index[name]
+        return buffer(self.map,offset,length)
+
+def export_item_pack(pack_file,split_location="temp"):
+    # Writes the records of an item pack out as files in split_location (the layout RuG/L04 reads)
+    pack = ItemPack(pack_file)
+    if not os.path.isdir(split_location): os.makedirs(split_location)
+    for name in pack.names(): open(os.path.join(split_location,name),"wb").write(pack.item(name))
+    return len(pack.names())
+
+# --distances does what RuG/L04 would do with the item files: for each pair of dialects
+# (wordlist columns), the average over the items of the Levenshtein distance between their
+# forms.  Forms are compared as sequences of phoneme tokens: ipa_tokens splits them with the unicode-ipa
+# column's longest-match trie (as convert() does), so a symbol such as a long vowel or an affricate is one
+# token, and a combining mark or modifier letter that isn't part of a symbol goes with the character before it
+# (so it makes that token a different one, rather than being an extra edit).  Each item's distinct forms are
+# compared only once, and the items are shared out between --jobs processes.
+
+def ipa_tokens(text):
+    # Splits unicode IPA text (as decode_unicode_ipa makes it) into phoneme tokens, ignoring spaces
+    import unicodedata
+    trie = get_converter("unicode-ipa","x-sampa").trie
+    tokens = [] ; pos = 0 ; end = len(text)
+    while pos < end:
+        node = trie ; nextPos = pos ; matchEnd = None
+        while nextPos < end:
+            node = node.get(text[nextPos])
+            if node==None: break
+            nextPos += 1
+            if node.has_key(None): matchEnd = nextPos
+        if matchEnd==None:
+            c = text[pos] ; matchEnd = pos+1
+            if c.isspace(): pass
+            elif tokens and unicodedata.category(c) in ["Mn","Lm","Sk"]: tokens[-1] += c
+            else: tokens.append(c)
+        elif not text[pos:matchEnd].isspace(): tokens.append(text[pos:matchEnd])
+        pos = matchEnd
+    return tokens
+
+def levenshtein(a,b):
+    # Edit distance between two sequences
+    if len(a) < len(b): a,b = b,a
+    previous = range(len(b)+1)
+    for i,x in enumerate(a):
+        current = [i+1]
+        for j,y in enumerate(b): current.append(min(previous[j+1]+1,current[j]+1,previous[j]+(x!=y)))
+        previous = current
+    return previous[-1]
+
+def form_distance(variants1,variants2):
+    # Distance between two dialects' forms of an item: their closest pair of variants, divided by the longer one's length
+    return min([float(levenshtein(a,b))/max(len(a),len(b)) for a in variants1 for b in variants2])
+
+def item_distance_sums((items,numDialects)):
+    # items is a list of each item's forms (a tuple for each dialect of its variants, each a tuple of token numbers;
+    # empty if there's no data).  Returns the total distance and the number of items compared, for each pair of
+    # dialects i<j in order.  (Module-level so a process pool can call it.)
+    numPairs = numDialects*(numDialects-1)/2
+    sums = [0.0]*numPairs ; counts = [0]*numPairs
+    for forms in items:
+        memo = {} ; k = 0
+        for i in xrange(numDialects):
+            for j in xrange(i+1,numDialects):
+                if forms[i] and forms[j]:
+                    key = (forms[i],forms[j])
+                    if not memo.has_key(key): memo[key] = memo[(forms[j],forms[i])] = form_distance(forms[i],forms[j])
+                    sums[k] += memo[key] ; counts[k] += 1
+                k += 1
+    return sums,counts
+
+def dialect_distances(items,numDialects,jobs=1):
+    # Returns the numDialects x numDialects matrix of average distances (None where two dialects have no items in common)
+    chunks = [(items[i::max(1,jobs*4)],numDialects) for i in xrange(max(1,jobs*4))]
+    if jobs<=1: results = map(item_distance_sums,chunks)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try: results = pool.map(item_distance_sums,chunks)
+        finally: pool.close() ; pool.join()
+    matrix = [[0.0]*numDialects for i in xrange(numDialects)] ; k = 0
+    for i in xrange(numDialects):
+        for j in xrange(i+1,numDialects):
+            total,count = sum([r[0][k] for r in results]),sum([r[1][k] for r in results])
+            if count: matrix[i][j] = matrix[j][i] = total/count
+            else: matrix[i][j] = matrix[j][i] = None
+            k += 1
+    return matrix
+
+def write_distance_matrix(fname,labels,matrix):
+    # Tab-separated, with the labels along the top and down the side
+    f = open(fname,"w")
+    f.write(u"\t".join([u""]+labels).encode('utf-8')+"\n")
+    for label,row in zip(labels,matrix): f.write(u"\t".join([label]+[("%.4f" % d if not d==None else u"") for d in row]).encode('utf-8')+"\n")
+    f.close()
+
+def convert_wordlist(mapping_file,wordlist_file,distances=False,jobs=1):
+    table = read_mapping_file(mapping_file)
+    tokenIds = {} ; forms = [] # (for distances)
+    def variant_tokens(col):
+        # Each variant (separated by ;) of a form, as a tuple of token numbers
+        ret = []
+        for variant in col.split(u";"):
+            tokens = tuple([tokenIds.setdefault(t,len(tokenIds)) for t in ipa_tokens(decode_unicode_ipa(u"".join([c for c in variant if table.get(ord(c))])))])
+            if tokens: ret.append(tokens)
+        return tuple(ret)
+    known = frozenset(unichr(c) for c in table)
+    from collections import OrderedDict
+    orphans = OrderedDict() # character -> line numbers where it has no mapping
+    written = [wordlist_file+'.converted',wordlist_file+'.items']
+    inFile = open(wordlist_file)
+    outFile = open(written[0],"w")
+    pack = ItemPackWriter(written[1])
+    header = inFile.readline() ; outFile.write(header)
+    labels = [l.rstrip("\n") for l in perl_split(u"\t",header.decode('utf-8'))]
+    pack.add('_LABELS_.LBL',u"".join([u"%4s\t%s\n" % (n,label) for n,label in enumerate(labels[1:],1)]).encode('utf-8'))
+    for lineNo,line in enumerate(inFile,2):
+        line = line.decode('utf-8').rstrip("\n")
+        if not line.strip(): continue # (blank lines, e.g. at the end of the file)
+        columns = perl_split(u"\t",line)
+        m = len(columns)>=2 and re.search(u'"(.+)"',columns[0])
+        if not m:
+            outFile.close() ; pack.close()
+            for fname in written: os.remove(fname)
+            sys.stderr.write("Error: Problem with data file: weird item gloss on line %d (empty, or has quotes?)\n" % lineNo) ; sys.exit(1)
+        gloss = m.group(1) ; items = []
+        for col in columns[1:]:
+            for c in set(col)-known:
+                if not c.isspace() and orphans.setdefault(c,[lineNo])[-1]!=lineNo: orphans[c].append(lineNo)
+            if col.strip(): items.append(col.translate(table))
+            else: items.append(u"")
+        if orphans: continue # still read the rest, to report all of them
+        outFile.write(u"\t".join([gloss]+items).encode('utf-8')+"\n")
+        pack.add(gloss.encode('utf-8')+'.txt',u"".join([u": %s\n- %s\n" % (label,u"\n- ".join(perl_split(u"\s*;\s*",item))) for label,item in zip(labels[1:],items) if item.strip()]).encode('utf-8'))
+        if distances: forms.append([variant_tokens(col) for col in columns[1:len(labels)]]+[()]*(len(labels)-len(columns)))
+    outFile.close() ; pack.close()
+    if orphans:
+        for fname in written: os.remove(fname)
+        sys.stderr.write("I found some characters in your wordlist file that have no mapping in your mapping file.\nHere's what I found:\n")
+        for c in sorted(orphans.keys()): sys.stderr.write((u"Character %s (Unicode codepoint %#06x) was found on line(s) %s.\n" % (c,ord(c),", ".join(map(str,orphans[c])))).encode('utf-8'))
+        sys.stderr.write("No conversion done.\n") ; sys.exit(1)
+    print "Wrote %s, and %d labels and %d wordlist items to %s" % (written[0],len(labels)-1,len(pack.index)-1,written[1])
+    if distances:
+        write_distance_matrix(wordlist_file+'.distances',labels[1:],dialect_distances(forms,len(labels)-1,jobs))
+        print "Wrote the distances between the %d dialects to %s" % (len(labels)-1,wordlist_file+'.distances')
+
+def markup_inline_word(format,pronunc,first_word=True):
     if format=="espeak": return "[["+pronunc+"]]"
     elif format=="mac": return "[[inpt PHON]]"+pronunc+"[[inpt TEXT]]"
     elif format=="sapi": return "<pron sym=\""+pronunc+"\"/>"
     elif format=="cepstral": return "<phoneme ph='"+pronunc+"'>p</phoneme>"
     elif format=="acapela-uk": return "\\Prn="+pronunc+"\\"
-    elif format=="bbcmicro" and first_word:
-       first_word = False
-       return "*SPEAK "+pronunc
+    elif format=="bbcmicro" and first_word: return "*SPEAK "+pronunc
     elif format=="unicode-ipa": return pronunc.encode("utf-8") # UTF-8 output - ok for pasting into Firefox etc *IF* the terminal/X11 understands utf-8 (otherwise redirect to a file, point the browser at it, and set encoding to utf-8, or try --convert'ing which will o/p HTML)
     else: return pronunc # fallback - assume the user knows what to do with it
 
+class InlineMarkup(object):
+    # Marks up the words of one output stream in turn (bbcmicro needs *SPEAK before the first word only)
+    def __init__(self,format): self.format,self.first_word = format,True
+    def __call__(self,pronunc):
+        ret = markup_inline_word(self.format,pronunc,self.first_word)
+        self.first_word = False ; return ret
+
+# --phones streams: the text is read a line at a time and split into sentences, which go to
+# espeak in chunks (one sentence per line) through an EspeakPool, keeping a few chunks in
+# flight so espeak works on the next ones while each is converted, marked up and written out.
+# So memory use and the wait for the first output don't grow with the length of the text.
+sentence_end_pattern = r'(?<=[.!?])\s+(?=[^\sa-z])|\n\s*\n' # (not before a small letter, as after 'e.g.'; a blank line ends a paragraph)
+max_sentence_length = 2000 # characters, after which a sentence with no full stop is split at a space
+phones_chunk_size = 50 # sentences per espeak run
+
+def text_sentences(inFile):
+    # Yields the sentences of the text in inFile, each on one line
+    pending = ""
+    for line in inFile:
+        parts = re.split(sentence_end_pattern,pending+line)
+        pending = parts.pop()
+        while len(pending) > max_sentence_length:
+            i = pending.rfind(" ",0,max_sentence_length)
+            if i<1: i = max_sentence_length
+            parts.append(pending[:i]) ; pending = pending[i:]
+        for p in parts:
+            if p.strip(): yield " ".join(p.split())
+    if pending.strip(): yield " ".join(pending.split())
+
+def phones_stream(inFile,outFile,format,jobs=1):
+    # Writes the phones of the text in inFile, marked up for 'format', as for --phones: words
+    # separated by spaces and espeak's clauses by commas, ending with a newline
+    espeak = EspeakPool(jobs,"espeak -q -x",phones_chunk_size)
+    markup = InlineMarkup(format) ; sentences = text_sentences(inFile)
+    inFlight = [] ; separator = ""
+    try:
+        while True:
+            while len(inFlight) <= jobs:
+                chunk = list(itertools.islice(sentences,phones_chunk_size))
+                if not chunk: break
+                inFlight.append(espeak.submit(chunk,raw=True)) # (the output is one stream, so espeak's lines needn't match the sentences)
+            if not inFlight: break
+            clauses = [c.split() for c in inFlight.pop(0).result()]
+            converted = iter(convert_many([word for c in clauses for word in c],"espeak",format))
+            for c in clauses:
+                outFile.write(separator+" ".join([markup(converted.next()) for word in c])) ; separator = ", "
+            outFile.flush()
+    finally: espeak.close()
+    outFile.write("\n")
+
+def get_jobs():
+    # Takes --jobs N out of the arguments (so it doesn't get in the way of the phones etc), and returns N, the number of processes to use (default 1)
+    if not '--jobs' in sys.argv: return 1
+    i = sys.argv.index('--jobs')
+    try: jobs = max(1,int(sys.argv[i+1]))
+    except (IndexError,ValueError):
+        sys.stderr.write("Error: --jobs must be followed by the number of processes to use\n") ; sys.exit(1)
+    del sys.argv[i:i+2]
+    return jobs
+
+def get_cache_size():
+    # Takes --cache-size N out of the arguments (so it doesn't get in the way of the phones etc), and returns N (default 0)
+    if not '--cache-size' in sys.argv: return 0
+    i = sys.argv.index('--cache-size')
+    try: size = max(0,int(sys.argv[i+1]))
+    except (IndexError,ValueError):
+        sys.stderr.write("Error: --cache-size must be followed by the number of conversions to remember\n") ; sys.exit(1)
+    del sys.argv[i:i+2]
+    return size
+
+def get_profile_options():
+    # Takes --profile and --profile-dump <file> out of the arguments, and turns on profiling if either was given
+    cprofile_file = None
+    if '--profile-dump' in sys.argv:
+        i = sys.argv.index('--profile-dump')
+        try: cprofile_file = sys.argv[i+1]
+        except IndexError:
+            sys.stderr.write("Error: --profile-dump must be followed by the file to write cProfile stats to\n") ; sys.exit(1)
+        del sys.argv[i:i+2]
+    elif not '--profile' in sys.argv: return
+    while '--profile' in sys.argv: sys.argv.remove('--profile')
+    enable_profiling(cprofile_file)
+
 def main():
+    set_conversion_cache_size(get_cache_size())
+    get_profile_options()
+    jobs = get_jobs()
     if '--festival-dictionary-to-espeak' in sys.argv:
         try: festival_location=sys.argv[sys.argv.index('--festival-dictionary-to-espeak')+1]
         except IndexError:
@@ -569,7 +1725,7 @@ def main():
         try: open("en_list")
         except:
             sys.stderr.write("Error: en_list could not be opened (did you remember to cd to the eSpeak dictsource directory first?\n") ; sys.exit(1)
-        convert_system_festival_dictionary_to_espeak(festival_location,not '--without-check' in sys.argv,not os.system("test -e ~/.festivalrc"))
+        convert_system_festival_dictionary_to_espeak(festival_location,not '--without-check' in sys.argv,not os.system("test -e ~/.festivalrc"),jobs)
     elif '--oed' in sys.argv:
         sys.stderr.write("Copy the pronunciation entries from the OED and paste into here\n"
         "The browser should copy the images' ALT text i.e. {zh}, {edh}, {ng}, etc.\n"
@@ -589,16 +1745,68 @@ def main():
     elif '--phones' in sys.argv:
         i=sys.argv.index('--phones')
         format=sys.argv[i+1]
-        w,r=os.popen4("espeak -q -x")
-        w.write(' '.join(sys.argv[i+2:])) ; w.close()
-        print ", ".join([" ".join([markup_inline_word(format,convert(word,"espeak",format)) for word in line.split()]) for line in filter(lambda x:x,r.read().split("\n"))])
+        if sys.argv[i+2:] in [[],['-']]: inFile = sys.stdin
+        elif sys.argv[i+2]=='--file':
+            try: inFile=open(sys.argv[i+3])
+            except IndexError:
+                sys.stderr.write("Error: --file must be followed by the name of the file to convert\n") ; sys.exit(1)
+            except IOError:
+                sys.stderr.write("Error: The file '"+sys.argv[i+3]+"' could not be opened\n") ; sys.exit(1)
+        else: inFile = [' '.join(sys.argv[i+2:])]
+        phones_stream(inFile,sys.stdout,format,jobs)
     elif '--phones2phones' in sys.argv:
         i=sys.argv.index('--phones2phones')
         format1,format2 = sys.argv[i+1],sys.argv[i+2]
         text=' '.join(sys.argv[i+3:])
-        if format1 in formats_where_space_separates_words:
-          for w in text.split(): print markup_inline_word(format2, convert(w,format1,format2))
+        if sys.argv[i+3:] in [[],['-']]: convert_phones_stream(sys.stdin,sys.stdout,format1,format2)
+        elif sys.argv[i+3]=='--file':
+            try: inFile=open(sys.argv[i+4])
+            except IndexError:
+                sys.stderr.write("Error: --file must be followed by the name of the file to convert\n") ; sys.exit(1)
+            except IOError:
+                sys.stderr.write("Error: The file '"+sys.argv[i+4]+"' could not be opened\n") ; sys.exit(1)
+            convert_phones_stream(inFile,sys.stdout,format1,format2)
+        elif format1 in formats_where_space_separates_words:
+          markup = InlineMarkup(format2)
+          for w in text.split(): print markup(convert(w,format1,format2))
         else: print markup_inline_word(format2, convert(text,format1,format2))
+    elif '--server' in sys.argv:
+        try: address = sys.argv[sys.argv.index('--server')+1]
+        except IndexError:
+            sys.stderr.write("Error: --server must be followed by a port number or the path of a Unix socket\n") ; sys.exit(1)
+        serve(address,jobs)
+    elif '--check-table' in sys.argv:
+        i=sys.argv.index('--check-table')
+        if sys.argv[i+1:i+2] and not sys.argv[i+1].startswith('--'):
+            if not sys.argv[i+2:]:
+                sys.stderr.write("Error: --check-table must be followed by nothing, or by a format and a file of pronunciations in that format\n") ; sys.exit(1)
+            check_table(sys.argv[i+1],sys.argv[i+2],jobs)
+        else: check_table(jobs=jobs)
+    elif '--homophones' in sys.argv:
+        i=sys.argv.index('--homophones')
+        if not sys.argv[i+1:]:
+            sys.stderr.write("Error: --homophones must be followed by the lexicon's format (and optionally its file)\n") ; sys.exit(1)
+        fname = None
+        if sys.argv[i+2:i+3] and not sys.argv[i+2].startswith('--'): fname = sys.argv[i+2]
+        elif sys.argv[i+1]=="oald":
+            sys.stderr.write("Error: --homophones oald must be followed by the location of the festival OALD file\n") ; sys.exit(1)
+        maxDistance = None
+        if '--near' in sys.argv:
+            try: maxDistance = int(sys.argv[sys.argv.index('--near')+1])
+            except (IndexError,ValueError):
+                sys.stderr.write("Error: --near must be followed by a number of edits\n") ; sys.exit(1)
+        report_homophones(sys.argv[i+1],fname,maxDistance)
+    elif '--export-items' in sys.argv:
+        i=sys.argv.index('--export-items')
+        if not sys.argv[i+1:]:
+            sys.stderr.write("Error: --export-items must be followed by the .items file (and optionally the directory to write to)\n") ; sys.exit(1)
+        split_location = (sys.argv[i+2:] or ["temp"])[0]
+        print "Wrote %d files in %s" % (export_item_pack(sys.argv[i+1],split_location),split_location)
+    elif '--wordlist' in sys.argv:
+        i=sys.argv.index('--wordlist')
+        if not sys.argv[i+2:]:
+            sys.stderr.write("Error: --wordlist must be followed by the mapping file and the wordlist file (see help text)\n") ; sys.exit(1)
+        convert_wordlist(sys.argv[i+1],sys.argv[i+2],distances='--distances' in sys.argv,jobs=jobs)
     elif '--convert' in sys.argv:
         i=sys.argv.index('--convert')
         fromFormat = sys.argv[i+1]
@@ -639,8 +1847,15 @@ def main():
         print "\nUse --convert <from-format> <to-format> to convert a user lexicon file.  Expects Festival's .festivalrc to be in the home directory, or espeak's en_extra or Cepstral's lexicon.txt to be in the current directory.\nE.g.: python lexconvert.py --convert festival cepstral"
         print "\nUse --try <format> <pronunciation> to try a pronunciation with eSpeak (requires 'espeak' command),\n e.g.: python lexconvert.py --try festival h @0 l ou1\n or: python lexconvert.py --try unicode-ipa '\\u02c8\\u0279\\u026adn\\u0329' (for Unicode put '\\uNNNN' or UTF-8)\n (it converts to espeak format and then uses espeak to play it)\nUse --trymac to do the same as --try but with Mac OS 'say' instead of 'espeak'"
         print "\nUse --oed to try some pronunciations from the Oxford English Dictionary (OED) website: it will prompt you to paste in the pronunciations and use eSpeak to display and pronounce each alternative.  (Note the OED notation can specify alternatives even in one marking, so you may get more than you expect.)"
-        print "\nUse --phones <format> <words> to convert 'words' to phones in format 'format'.  espeak will be run to do the text-to-phoneme conversion, and the output will then be converted to 'format'.\nE.g.: python lexconvert.py --phones unicode-ipa This is a test sentence.\nNote that some commercial speech synthesizers do not work well when driven entirely from phones, because their internal format is different and is optimised for normal text."
-        print "\nUse --phones2phones <format1> <format2> <phones in format1> to perform a one-off conversion of phones from format1 to format2."
-        print "\nUse --festival-dictionary-to-espeak <location> to convert the Festival Oxford Advanced Learners Dictionary (OALD) pronunciation lexicon to ESpeak.\nYou need to specify the location of the OALD file in <location>,\ne.g. for Debian festlex-oald package: python lexconvert.py --festival-dictionary-to-espeak /usr/share/festival/dicts/oald/all.scm\nor if you can't install the Debian package, try downloading http://ftp.debian.org/debian/pool/non-free/f/festlex-oald/festlex-oald_1.4.0.orig.tar.gz, unpack it into /tmp, and do: python lexconvert.py --festival-dictionary-to-espeak /tmp/festival/lib/dicts/oald/oald-0.4.out\nIn all cases you need to cd to the espeak source directory before running this.  en_extra will be overwritten.  Converter will also read your ~/.festivalrc if it exists.  (You can later incrementally update from ~/.festivalrc using the --convert option; the entries from the system dictionary will not be overwritten in this case.)  Specify --without-check to bypass checking the existing espeak pronunciation for OALD entries (much faster, but makes a larger file and in some cases compromises the pronunciation quality)."
+        print "\nUse --phones <format> <words> to convert 'words' to phones in format 'format'.  espeak will be run to do the text-to-phoneme conversion, and the output will then be converted to 'format'.\nE.g.: python lexconvert.py --phones unicode-ipa This is a test sentence.\nIf no words are given (or just '-'), the text is read from standard input, or use --phones <format> --file <file>; long texts are done a few sentences at a time, and output as they are done (--jobs N runs up to N espeak processes at once).\nNote that some commercial speech synthesizers do not work well when driven entirely from phones, because their internal format is different and is optimised for normal text."
+        print "\nUse --phones2phones <format1> <format2> <phones in format1> to perform a one-off conversion of phones from format1 to format2.\nIf no phones are given (or just '-'), they are read from standard input instead, one output line per input line (tab-separated fields are kept separate), or use --phones2phones <format1> <format2> --file <filename> to read them from a file.\nE.g.: python lexconvert.py --phones2phones unicode-ipa x-sampa < wordlist.txt > wordlist-xsampa.txt"
+        print "\nUse --wordlist <mapping file> <wordlist file> to convert a wordlist through a mapping file such as IPA2XSAMPA.csv (as the 'conversion' script does).  The wordlist is tab-separated, with a row of labels first and a quoted gloss at the start of each row.  The result is written to <wordlist file>.converted, and its items (one record per gloss, plus _LABELS_.LBL) are packed into <wordlist file>.items; use --export-items <wordlist file>.items [directory] to write them out as the separate files RuG/L04 reads (in 'temp' by default).  Nothing is written if any character has no mapping; those characters are listed instead.  Add --distances to also write <wordlist file>.distances, a tab-separated matrix of the average Levenshtein distance between each pair of dialects (columns), comparing their forms phoneme by phoneme (where a form has variants separated by ';', the closest pair is used, and each distance is divided by the longer form's length); --jobs N shares this out between N processes."
+        print "\nUse --festival-dictionary-to-espeak <location> to convert the Festival Oxford Advanced Learners Dictionary (OALD) pronunciation lexicon to ESpeak.\nYou need to specify the location of the OALD file in <location>,\ne.g. for Debian festlex-oald package: python lexconvert.py --festival-dictionary-to-espeak /usr/share/festival/dicts/oald/all.scm\nor if you can't install the Debian package, try downloading http://ftp.debian.org/debian/pool/non-free/f/festlex-oald/festlex-oald_1.4.0.orig.tar.gz, unpack it into /tmp, and do: python lexconvert.py --festival-dictionary-to-espeak /tmp/festival/lib/dicts/oald/oald-0.4.out\nIn all cases you need to cd to the espeak source directory before running this.  en_extra will be overwritten.  Converter will also read your ~/.festivalrc if it exists.  (You can later incrementally update from ~/.festivalrc using the --convert option; the entries from the system dictionary will not be overwritten in this case.)  Specify --without-check to bypass checking the existing espeak pronunciation for OALD entries (much faster, but makes a larger file and in some cases compromises the pronunciation quality).  Specify --jobs N to do the conversion in N processes.  What was converted is remembered in en_extra.manifest, so that running this again converts and checks only the entries that have changed (delete en_extra.manifest to redo everything, e.g. after upgrading eSpeak)."
+        print "\nUse --check-table to check the table (for maintainers): for each format, it lists symbols that are in more than one row (only the first of those rows is used when converting from that format), and then converts each format's symbols to every other format and back, reporting the ones that don't come back the same.  Add <format> <file> to also round-trip the pronunciations in <file> (one per line, in <format>), and --jobs N to use N processes."
+        print "\nUse --homophones <format> [<file>] to list the words in a lexicon that are pronounced the same, ignoring the differences that --festival-dictionary-to-espeak's check ignores (the pronunciations are converted to eSpeak and simplified; the output has each simplified pronunciation that more than one word has, followed by the words).  <format> is festival, espeak or cepstral (the file defaults to that format's user lexicon, as for --convert), or oald with the location of the Festival OALD file.  Add --near N to look up pronunciations instead: they are read from standard input (in <format>), one per line, and each is followed by the words whose pronunciations are within N edits of it."
+        print "\nUse --server <port> to run a conversion server on that port of localhost (or --server <path> to use a Unix socket).  Each request is a line of JSON, either {\"source\":\"festival\",\"dest\":\"unicode-ipa\",\"words\":[\"h @0 l ou1\"]} to convert words, or {\"dest\":\"unicode-ipa\",\"text\":\"Hello world\"} to convert text to phones with espeak; the response is a line of JSON with \"results\" (a list of pronunciations) or \"error\".  Requests from many clients at once are converted in batches; use --jobs N to run up to N espeak processes at once."
+        print "\nAny of the options above can be given --cache-size N to remember up to N conversions, so that repeated pronunciations are converted only once (a summary of the cache hits is written to standard error at the end)."
+        print "\nAny of the options above can also be given --profile to print how long each stage took (and how many items it did) at the end, or --profile-dump <file> to do that and also save cProfile statistics to <file> (for use with Python's pstats module)."
+    if conversion_cache: sys.stderr.write("Conversion cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions (%(size)d of %(maxsize)d entries used)\n" % conversion_cache_stats())
 
 if __name__ == "__main__": main()
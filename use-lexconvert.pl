@@ -11,12 +11,12 @@
 # words at a time between these formats, so this program just takes the spreadsheet
 # and feeds one word at a time to lexconvert.
 #
-# Usage is "ipa2xsampa.pl < infile > outfile". lexconvert.py must be in the same directory.
+# Usage is "ipa2xsampa.pl < infile > outfile" (or "ipa2xsampa.pl infile(s) > outfile"). lexconvert.py must be in the same directory.
+#
+# lexconvert.py can now read the whole spreadsheet from standard input itself (one output
+# line per input line, tabs kept), so it is started once instead of once per row.
 
 
-while (<>) {
-	chomp($_);
-	$out = `./lexconvert.py --phones2phones unicode-ipa x-sampa $_`;
-	$out =~ s/\n/\t/g;
-	print "$out\n";
-	}
+open(LEXCONVERT, "|-", "python", "lexconvert.py", "--phones2phones", "unicode-ipa", "x-sampa", "-") or die "Can't run lexconvert.py: $!\n";
+while (<>) { print LEXCONVERT $_; } # (standard input, or the files named on the command line)
+close(LEXCONVERT) or die "lexconvert.py failed\n";